@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Codec micro-benchmarks, driven by the packets in traces/*.txt.
+# No hardware needed.
+#
+# Re-encodes every traced packet with Packet.pack, then feeds the encoded
+# stream back through PacketReceiver.parse in chunks from 1 byte (what
+# ReceiverThread historically read) up to 64 KiB, clean and with injected
+# garbage and CRC errors. Reports packets/sec, bytes/sec and peak memory
+# allocated per run, and can save or compare against a JSON baseline.
+#
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import fyproto
+import fytrace
+
+CHUNK_SIZES = (1, 16, 256, 4096, 65536)
+
+
+def load_packets(files):
+    packets = []
+    for filename in files:
+        packets.extend(record.packet for record in fytrace.read_trace(filename))
+    return packets
+
+
+def noisy_stream(packets, garbage_rate, corrupt_rate, seed=1):
+    '''Encoded stream with random garbage between some packets,
+       and a flipped byte inside others (which then fail their CRC).
+       '''
+    rng = random.Random(seed)
+    parts = []
+    for packet in packets:
+        encoded = bytearray(packet.pack())
+        if rng.random() < corrupt_rate:
+            encoded[rng.randrange(2, len(encoded))] ^= 1 << rng.randrange(8)
+        parts.append(encoded)
+        if rng.random() < garbage_rate:
+            parts.append(bytes(rng.randrange(256) for i in range(rng.randrange(1, 32))))
+    return b''.join(parts)
+
+
+def chunked(stream, size):
+    return [stream[i:i+size] for i in range(0, len(stream), size)]
+
+
+def run_pack(packets):
+    for packet in packets:
+        packet.pack()
+    return len(packets)
+
+
+def run_pack_into(packets):
+    buffer = bytearray(2048)
+    for packet in packets:
+        packet.pack_into(buffer)
+    return len(packets)
+
+
+def run_parse(chunks):
+    receiver = fyproto.PacketReceiver()
+    count = 0
+    for chunk in chunks:
+        for packet in receiver.parse(chunk):
+            count += 1
+    return count
+
+
+def run_decode_buffer(stream):
+    return len(fyproto.decode_buffer(stream))
+
+
+def measure(fn, arg, repeat):
+    '''Best wall-clock time over 'repeat' runs, the run's return value,
+       and peak traced allocation size from one extra run.
+       '''
+    best = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = fn(arg)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start()
+        fn(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, result, peak
+
+
+def cases(packets, args):
+    clean = b''.join(p.pack() for p in packets)
+    noisy = noisy_stream(packets, args.garbage_rate, args.corrupt_rate)
+
+    yield 'pack', run_pack, packets, len(clean)
+    yield 'pack_into', run_pack_into, packets, len(clean)
+    for name, stream in (('clean', clean), ('noisy', noisy)):
+        for size in CHUNK_SIZES:
+            yield 'parse-%s-%d' % (name, size), run_parse, chunked(stream, size), len(stream)
+        if fyproto.numpy is not None:
+            yield 'decode_buffer-%s' % name, run_decode_buffer, stream, len(stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the packet codec against recorded traces')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--garbage-rate', type=float, default=0.05)
+    parser.add_argument('--corrupt-rate', type=float, default=0.02)
+    parser.add_argument('--save', metavar='FILE', help='Write results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against a saved JSON baseline')
+    parser.add_argument('files', nargs='*', help='Trace files (default: traces/*.txt)')
+    args = parser.parse_args()
+
+    packets = load_packets(args.files or fytrace.trace_files())
+    print("Loaded %d packets" % len(packets))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print("%-24s %12s %14s %12s %10s" % ('case', 'packets/s', 'bytes/s', 'alloc peak', 'vs base'))
+    for name, fn, arg, nbytes in cases(packets, args):
+        elapsed, count, peak = measure(fn, arg, args.repeat)
+        results[name] = {
+            'packets': count,
+            'packets_per_sec': count / elapsed,
+            'bytes_per_sec': nbytes / elapsed,
+            'alloc_peak': peak,
+        }
+        ratio = ''
+        if name in baseline:
+            ratio = '%.2fx' % (results[name]['bytes_per_sec'] / baseline[name]['bytes_per_sec'])
+        print("%-24s %12.0f %14.0f %12d %10s" % (
+            name, results[name]['packets_per_sec'], results[name]['bytes_per_sec'], peak, ratio))
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,17 +12,17 @@
 # - Also runs a websocket server for live poking at parameters.
 #
 
-import time
 import argparse
 import struct
 
 from fyproto import Packet
 from fyserial import GimbalPort
+from fyloop import ControlLoop
 from fysocketserver import run_server_thread
 from tinyjoy import deadzone, JoystickThread
 
 
-def controller(gimbal, js, hz=75.0, yaw_limits=(450, 3800), pitch_limits=(-10000, 10000)):
+def controller(gimbal, js, hz=75.0, yaw_limits=(450, 3800), pitch_limits=(-10000, 10000), overrun='skip'):
 
     # Follow loops all off
     gimbal.setVectorParam(number=0x63, value=(0,0,0))
@@ -33,50 +33,66 @@ def controller(gimbal, js, hz=75.0, yaw_limits=(450, 3800), pitch_limits=(-10000
     # Turn motors on if they aren't already
     gimbal.setMotors(True)
 
-    while True:
-        time.sleep(1.0/hz)
-        controls = js.state()
+    # Poll the angles we need in the background, at the loop rate
+    yaw_reading = gimbal.telemetry.subscribe(number=0x2c, target=0, rate=hz)
+    pitch_reading = gimbal.telemetry.subscribe(number=0x09, target=2, rate=hz)
+    yaw_reading.wait(timeout=gimbal.operationTimeout)
+    pitch_reading.wait(timeout=gimbal.operationTimeout)
 
-        # Yaw is a speed (angle per time) integrated on MCU0
-        command_yaw_speed = int(pow(deadzone(controls.get('rx', 0)), 3.0) * -300)
+    # Runs on absolute deadlines, jitter and latency are in the 'stats' websocket command
+    loop = ControlLoop(hz, overrun=overrun, metrics=gimbal.metrics, name='controller')
+    loop.run(lambda: control_step(gimbal, js, yaw_reading, pitch_reading, yaw_limits))
 
-        # In this example the Pitch input is speed, but we are commanding
-        # the gimbal by sending a joystick packet (in faux-servo units)
-        # which applies an offset to the target of its follow loop
-        command_pitch_speed = int(pow(deadzone(controls.get('ry', 0)), 3.0) * -150)
 
-        # For this particular controller's purposes, our most appropriate
-        # absolute notion of yaw (relative to the robot body) will be the
-        # magnetic encoder on the yaw axis.
-        current_yaw = gimbal.getParam(number=0x2c, target=0)
+def control_step(gimbal, js, yaw_reading, pitch_reading, yaw_limits):
+    controls = js.state()
 
-        # Current pitch vs the horizon comes from the gyro angle
-        current_pitch = gimbal.getParam(number=0x09, target=2)
+    # Yaw is a speed (angle per time) integrated on MCU0
+    command_yaw_speed = int(pow(deadzone(controls.get('rx', 0)), 3.0) * -300)
 
-        # Not perfect, but put the brakes on if we're out of yaw range
-        if current_yaw <= yaw_limits[0] and command_yaw_speed < 0:
-            command_yaw_speed = 0
-        if current_yaw >= yaw_limits[1] and command_yaw_speed > 0:
-            command_yaw_speed = 0
+    # In this example the Pitch input is speed, but we are commanding
+    # the gimbal by sending a joystick packet (in faux-servo units)
+    # which applies an offset to the target of its follow loop
+    command_pitch_speed = int(pow(deadzone(controls.get('ry', 0)), 3.0) * -150)
 
-        # Send latest yaw and pitch speeds
-        gimbal.setParam(number=0x03, target=0, value=command_yaw_speed)
-        gimbal.setParam(number=0x03, target=2, value=command_pitch_speed)
+    # Telemetry is polled in the background, so use the latest values
+    # rather than waiting on the serial link.
 
-        # Status!
-        print("Yaw: current=%d speed=%d  Pitch: current=%d speed=%d" % (
-            current_yaw, command_yaw_speed,
-            current_pitch, command_pitch_speed))
+    # For this particular controller's purposes, our most appropriate
+    # absolute notion of yaw (relative to the robot body) will be the
+    # magnetic encoder on the yaw axis.
+    current_yaw = yaw_reading.latest().value
+
+    # Current pitch vs the horizon comes from the gyro angle
+    current_pitch = pitch_reading.latest().value
+
+    # Not perfect, but put the brakes on if we're out of yaw range
+    if current_yaw <= yaw_limits[0] and command_yaw_speed < 0:
+        command_yaw_speed = 0
+    if current_yaw >= yaw_limits[1] and command_yaw_speed > 0:
+        command_yaw_speed = 0
+
+    # Send latest yaw and pitch speeds
+    gimbal.setParam(number=0x03, target=0, value=command_yaw_speed)
+    gimbal.setParam(number=0x03, target=2, value=command_pitch_speed)
+
+    # Status!
+    print("Yaw: current=%d speed=%d  Pitch: current=%d speed=%d" % (
+        current_yaw, command_yaw_speed,
+        current_pitch, command_pitch_speed))
 
 
 def main():
     parser = argparse.ArgumentParser(description='Simple remote for the Feiyu Tech gimbal')
     parser.add_argument('--port', default='/dev/ttyAMA0')
+    parser.add_argument('--rate', type=float, default=75.0, help='Control loop rate in Hz')
+    parser.add_argument('--catchup', action='store_true',
+        help='Run missed cycles after an overrun instead of skipping them')
     args = parser.parse_args()
     js = JoystickThread()
     gimbal = GimbalPort(args.port, verbose=False)
     run_server_thread(gimbal)
-    controller(gimbal, js)
+    controller(gimbal, js, hz=args.rate, overrun='catchup' if args.catchup else 'skip')
 
 
 if __name__ == '__main__':
@@ -33,7 +33,7 @@ class Decoder(srd.Decoder):
             byteval = bytes((pdata[0],))
             receiver = self.receivers[rxtx]
 
-            if len(receiver.buffer) == 0:
+            if len(receiver) == 0:
                 self.begin_ss = ss
             for packet in receiver.parse(byteval):
                 packet_ss = self.begin_ss or ss
@@ -0,0 +1,410 @@
+'''
+asyncio interface for talking to Feiyu Tech gimbals.
+
+Drives the serial port's file descriptor directly from the event loop, with
+no helper threads. Transactions are pipelined the same way as in
+fyserial.GimbalPort: requests go out in groups of up to 'pipelineWindow',
+responses are matched in order of issue, and a group is only completed once
+every request in it has been answered.
+
+A group that times out is retried in smaller groups, down to a single
+request, and retries are only used up by requests that got no answer at
+all, so a param that never answers doesn't fail the reads sent with it.
+Timeouts adapt to each target's measured round trip, as in
+fyserial.RoundTripEstimator, a request gives up after operationTimeout, and
+one that went unanswered is retried behind the other queued requests, so
+the unanswered param doesn't hold up the pump either.
+'''
+
+import asyncio
+import collections
+import os
+import struct
+
+import fyproto
+import fymetrics
+import fylog
+import serial
+from fyserial import Timeout, RoundTripEstimator
+
+
+class Request:
+    def __init__(self, packet, timeout, retries, future, deadline):
+        self.packet = packet
+        self.timeout = timeout
+        self.retries = retries
+        self.future = future
+        self.deadline = deadline
+
+
+class AsyncGimbalPort:
+    '''High-level connection to a Feiyu Tech gimbal, for use from an event loop.
+       Create it with 'await AsyncGimbalPort.open(...)'.
+
+       If reading or writing the port fails, the error is recorded in
+       'failed', and pending and later transactions raise IOError.
+       '''
+    receiverClass = fyproto.PacketReceiver
+
+    axes = range(3)
+    transactionRetries = 15
+    transactionTimeout = 2.0
+    operationTimeout = 5.0
+    drainTimeout = 0.05
+    pipelineWindow = 16
+    connectTimeout = 10.0
+    readSize = 4096
+
+    def __init__(self, port='/dev/ttyAMA0', baudrate=115200, verbose=True, loop=None, record=None):
+        self.verbose = verbose
+        self.version = None
+        self.failed = None
+        self.loop = loop or asyncio.get_event_loop()
+        self.connected = asyncio.Event()
+
+        self.port = serial.Serial(port, baudrate=baudrate)
+        self.fd = self.port.fileno()
+        os.set_blocking(self.fd, False)
+        self.receiver = self.receiverClass()
+        self._txBuffer = bytearray()
+
+        self.metrics = fymetrics.Metrics()
+        self.recorder = fylog.PacketRecorder(record) if record else None
+        self.metrics.gauge('tx.buffer_bytes', lambda: len(self._txBuffer))
+        self.metrics.gauge('tx.queue_depth', lambda: len(self._requests))
+        self.metrics.gauge('rx.crc_errors', lambda: self.receiver.crcErrors)
+        self.metrics.gauge('rx.resync_bytes', lambda: self.receiver.resyncBytes)
+
+        self.roundTrips = {}
+        self._requests = collections.deque()
+        self._requestsReady = asyncio.Event()
+        self._responses = asyncio.Queue()
+        self.loop.add_reader(self.fd, self._readable)
+        self._pump = self.loop.create_task(self._pumpRequests())
+
+    @classmethod
+    async def open(cls, *args, connected=None, **kw):
+        '''Open the port and check whether the gimbal is already in PC control mode'''
+        self = cls(*args, **kw)
+        if connected is None:
+            connected = await self._testForExistingConnection()
+        if connected:
+            self.connected.set()
+        if self.verbose:
+            if connected:
+                print("Already connected to gimbal, version %s" % self.version)
+            else:
+                print("Waiting for gimbal to power on")
+        return self
+
+    def stats(self):
+        '''Snapshot of link metrics: counters, latency percentiles and gauges'''
+        return self.metrics.snapshot()
+
+    def close(self):
+        self._pump.cancel()
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.port.close()
+        if self.recorder:
+            self.recorder.close()
+
+    async def _testForExistingConnection(self):
+        if self.verbose:
+            print("Checking for existing connection")
+        try:
+            paramVersion = await self.get_param(target=0, number=0x7f, retries=0, timeout=0.1, connect=False)
+            self.version = self.version or (paramVersion / 100)
+            return True
+        except Timeout:
+            return False
+
+    async def wait_connect(self, timeout=None):
+        if self.connected.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout or self.connectTimeout)
+        except asyncio.TimeoutError:
+            raise Timeout()
+
+    def send(self, packet):
+        '''Queue a packet for transmission, without waiting for the connection'''
+        if self.failed:
+            raise IOError("Port failed: %s" % self.failed)
+        if self.verbose:
+            print("TX %s" % packet)
+        start = len(self._txBuffer)
+        frame = packet.pack()
+        self._txBuffer += frame
+        self.metrics.count('tx.packets.cmd%02x' % packet.command)
+        self.metrics.count('tx.bytes.cmd%02x' % packet.command, len(frame))
+        if start == 0:
+            self._writable()
+
+    def _writable(self):
+        try:
+            written = os.write(self.fd, self._txBuffer)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            self._fail(e)
+            return
+        if self.recorder and written:
+            self.recorder.record(fylog.TX, memoryview(self._txBuffer)[:written])
+        del self._txBuffer[:written]
+        if self._txBuffer:
+            self.loop.add_writer(self.fd, self._writable)
+        else:
+            self.loop.remove_writer(self.fd)
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, self.readSize)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        if not data:
+            self._fail(IOError("End of file, the device is gone"))
+            return
+        self.metrics.count('rx.bytes', len(data))
+        if self.recorder:
+            self.recorder.record(fylog.RX, data)
+        for packet in self.receiver.parse(data):
+            if self.verbose:
+                print("RX %s" % packet)
+            self.metrics.count('rx.packets.cmd%02x' % packet.command)
+            self.metrics.count('rx.bytes.cmd%02x' % packet.command, packet.packed_size())
+            self._receive(packet)
+
+    def _fail(self, error):
+        '''Stop using a port that can't be read or written, and fail its requests'''
+        self.failed = error
+        self.metrics.count('port.failures')
+        if self.verbose:
+            print("Port failed: %s" % error)
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self._txBuffer.clear()
+        self._requestsReady.set()
+
+    def _receive(self, packet):
+        '''One packet received. Handles connection packets immediately,
+           and queues responses for the request pump.
+           '''
+        if packet.framing == fyproto.LONG_FORM:
+            if packet.command == 0x00:
+                self.cmd00 = packet
+                self.version = fyproto.VERSION.decode(packet).version / 100.0
+                return
+
+        if packet.framing == fyproto.SHORT_FORM:
+            if packet.command == 0x0B:
+                if self.verbose:
+                    print("Connecting to gimbal, firmware version %s" % self.version)
+                self.send(fyproto.Packet(target=0, command=0x0b, data=bytes([0x01])))
+                self.connected.set()
+                return
+
+            if packet.target == 0x03:
+                self._responses.put_nowait(packet)
+                return
+
+    async def _waitResponse(self, command, deadline):
+        while True:
+            timeout = max(0, deadline - self.loop.time())
+            try:
+                packet = await asyncio.wait_for(self._responses.get(), timeout)
+            except asyncio.TimeoutError:
+                raise Timeout()
+            if packet.command == command:
+                return packet
+            self.metrics.count('rx.ignored_responses')
+            if self.verbose:
+                print("Ignored response %r" % packet)
+
+    def _discardResponses(self):
+        '''Discard responses already queued, they answer earlier requests'''
+        while not self._responses.empty():
+            packet = self._responses.get_nowait()
+            self.metrics.count('rx.discarded_responses')
+            if self.verbose:
+                print("Discarded late response %r" % packet)
+
+    async def _drainResponses(self, timeout):
+        '''Discard responses until none arrive for 'timeout' seconds'''
+        while True:
+            try:
+                packet = await asyncio.wait_for(self._responses.get(), timeout)
+            except asyncio.TimeoutError:
+                return
+            self.metrics.count('rx.discarded_responses')
+            if self.verbose:
+                print("Discarded late response %r" % packet)
+
+    def roundTrip(self, target):
+        '''RoundTripEstimator for one target MCU'''
+        if target not in self.roundTrips:
+            self.roundTrips[target] = RoundTripEstimator(self.transactionTimeout, self.transactionTimeout,
+                max(RoundTripEstimator.minTimeout, self.groupWireTime()))
+        return self.roundTrips[target]
+
+    def groupWireTime(self):
+        '''Seconds to send a full pipelined group of reads and receive their responses'''
+        request = fyproto.Packet(target=0, command=0x06, data=b'\x00').packed_size()
+        response = fyproto.Packet(target=3, command=0x06, data=b'\x00\x00').packed_size()
+        return self.pipelineWindow * (request + response) * 10.0 / self.port.baudrate
+
+    def lateResponseTimeout(self, estimators):
+        '''How long to keep draining late responses after a timeout'''
+        return max(self.drainTimeout, max(RoundTripEstimator.k * e.maxRtt for e in estimators))
+
+    async def _pumpRequests(self):
+        '''Send queued requests in groups, and complete their futures.
+           As in GimbalPort.transactions(), the window halves after a loss
+           and grows back by one for each group that completes.
+           '''
+        window = self.pipelineWindow
+        clean = True
+        while True:
+            await self._requestsReady.wait()
+            group = []
+            while self._requests and len(group) < window:
+                request = self._requests.popleft()
+                if not request.future.done():
+                    group.append(request)
+            if not self._requests:
+                self._requestsReady.clear()
+            if self.failed:
+                for request in group:
+                    request.future.set_exception(IOError("Port failed: %s" % self.failed))
+                continue
+            if not group:
+                continue
+
+            # Later responses in a group queue up behind earlier ones,
+            # allow at worst one more round trip for each
+            estimators = set(self.roundTrip(r.packet.target) for r in group)
+            adaptive = (max(e.timeout() for e in estimators) +
+                (len(group) - 1) * max(e.srtt or 0 for e in estimators))
+            attemptTimeout = max(adaptive if r.timeout is None else r.timeout for r in group)
+            # Don't wait past the deadlines, but still give late requests a fair attempt
+            attemptTimeout = min(attemptTimeout, max(max(e.minTimeout for e in estimators),
+                max(r.deadline for r in group) - self.loop.time()))
+
+            self._discardResponses()
+            try:
+                for request in group:
+                    self.send(request.packet)
+            except OSError as e:
+                for request in group:
+                    request.future.set_exception(e)
+                continue
+            sent = self.loop.time()
+            responses = []
+            try:
+                for r in group:
+                    responses.append(await self._waitResponse(r.packet.command, sent + attemptTimeout))
+                    self.metrics.observe('transaction.latency.t%02x.cmd%02x' % (r.packet.target, r.packet.command),
+                        self.loop.time() - sent)
+                    # Only the first response measures a plain round trip, and only
+                    # when it can't be a late answer to an earlier attempt
+                    if len(responses) == 1 and clean:
+                        self.roundTrip(r.packet.target).sample(self.loop.time() - sent)
+            except Timeout:
+                pass
+
+            clean = len(responses) == len(group)
+            if clean:
+                for request, response in zip(group, responses):
+                    if not request.future.done():
+                        request.future.set_result(response)
+                window = min(self.pipelineWindow, window + 1)
+                continue
+
+            self.metrics.count('transaction.timeouts')
+            if not responses:
+                for e in estimators:
+                    e.backoff()
+            await self._drainResponses(self.lateResponseTimeout(estimators))
+            window = max(1, len(group) // 2)
+
+            # Responses don't say which request they answer, so after a
+            # partial group we can't tell which ones were answered. Those
+            # are retried first, in smaller groups, without using up their
+            # retries. Only requests that got no answer at all are charged,
+            # and they wait behind everything else queued.
+            now = self.loop.time()
+            retry = []
+            for request in group:
+                if not responses:
+                    request.retries -= 1
+                if request.retries < 0 or (not responses and now >= request.deadline):
+                    if not request.future.done():
+                        request.future.set_exception(Timeout())
+                    continue
+                self.metrics.count('transaction.retries')
+                if responses:
+                    retry.append(request)
+                else:
+                    self._requests.append(request)
+            self._requests.extendleft(reversed(retry))
+            if self._requests:
+                self._requestsReady.set()
+
+    async def transaction(self, packet, timeout=None, retries=None, connect=True):
+        '''Send a packet, and wait for the corresponding response, with retry on timeout.
+           Each attempt waits 'timeout' seconds if given, or the target's adaptive timeout.
+           '''
+        if self.failed:
+            raise IOError("Port failed: %s" % self.failed)
+        if connect:
+            await self.wait_connect()
+        request = Request(packet, timeout,
+            self.transactionRetries if retries is None else retries,
+            self.loop.create_future(), self.loop.time() + self.operationTimeout)
+        self._requests.append(request)
+        self._requestsReady.set()
+        return await request.future
+
+    async def set_motors(self, enable, targets=axes):
+        await self.wait_connect()
+        for t in sorted(targets, reverse=True):
+            self.send(fyproto.Packet(target=t, command=0x03, data=struct.pack('B', enable)))
+        if enable:
+            await self.set_param(target=2, number=0x67, value=1)
+
+    async def store_calibration_angle(self, num, targets=axes):
+        for target in targets:
+            await self.transaction(fyproto.Packet(target=target, command=0x0c, data=struct.pack('B', num)))
+
+    async def save_params(self, targets=axes, timeout=None, retries=None):
+        for target in targets:
+            p = fyproto.Packet(target=target, command=0x05, data=b'\x00')
+            r = await self.transaction(p, timeout=timeout, retries=retries)
+            if struct.unpack('<B', r.data)[0] != target:
+                raise IOError("Failed to save parameters, response %r" % r)
+            if self.verbose:
+                print("Saved params on MCU %d" % target)
+
+    async def get_param(self, target, number, fmt='h', timeout=None, retries=None, connect=True):
+        p = fyproto.Packet(target=target, command=0x06, data=struct.pack('B', number))
+        r = await self.transaction(p, timeout=timeout, retries=retries, connect=connect)
+        return struct.unpack('<' + fmt, r.data)[0]
+
+    async def get_params(self, params, fmt='h', timeout=None, retries=None):
+        '''Read a list of (target, number) params concurrently. Returns a list of values.'''
+        return await asyncio.gather(*(
+            self.get_param(t, n, fmt=fmt, timeout=timeout, retries=retries) for t, n in params))
+
+    async def set_param(self, target, number, value, fmt='h'):
+        await self.wait_connect()
+        self.send(fyproto.Packet(target=target, command=0x08, data=struct.pack('<BB' + fmt, number, 0, value)))
+
+    async def get_vector_param(self, number, targets=axes, timeout=None, retries=None):
+        return tuple(await self.get_params([(t, number) for t in targets], timeout=timeout, retries=retries))
+
+    async def set_vector_param(self, number, value, targets=axes):
+        for i, t in enumerate(targets):
+            await self.set_param(t, number, value[i])
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+'''
+Gimbal emulator on a pseudo-terminal, for testing without hardware.
+
+Plays the three MCUs of a Feiyu Tech gimbal behind a pty. Open the slave
+side (printed at startup, or GimbalEmulator.port) with GimbalPort,
+fysocketserver or fyflash.py in place of /dev/ttyAMA0.
+
+On power on the emulator announces its bootloader with cmd00 hellos. If
+the host answers with a long-form cmd01 it stays in the bootloader and
+accepts firmware blocks like fyflash.py sends them, otherwise it boots and
+offers the cmd0b handshake until the host acknowledges it. Once connected
+it answers param gets (cmd06), sets (cmd08), saves (cmd05), calibration
+angle stores (cmd0c) and motor switches (cmd03).
+
+Link imperfections are configurable: response latency, a baud rate limit
+on what the gimbal sends, and a rate of dropped or corrupted packets.
+'''
+
+import os
+import ast
+import tty
+import time
+import queue
+import random
+import struct
+import argparse
+import threading
+
+import fyproto
+import fyparams
+
+
+def load_params(filename=None):
+    '''128 rows of per-MCU param values, from params.txt (the default)
+       or from the output of param-dump.py
+       '''
+    with open(filename or fyparams.DEFAULT_FILENAME) as f:
+        text = f.read()
+    try:
+        slots = ast.literal_eval(text)
+    except (SyntaxError, ValueError):
+        schema = fyparams.parse_schema(text.splitlines())
+        slots = [schema[n].values if n in schema else (0, 0, 0) for n in range(128)]
+    return [list(values) for values in slots]
+
+
+class EmulatedMCU:
+    '''State for one of the gimbal's microcontrollers'''
+    def __init__(self, number, params):
+        self.number = number
+        self.params = list(params)
+        self.saved = list(params)
+        self.motors = 0
+        self.calibration = {}
+        self.firmware = {}
+
+
+class GimbalEmulator:
+    '''Emulated gimbal on a new pseudo-terminal. 'params' is a list of 128
+       per-MCU value triples, see load_params(). Latency is in seconds,
+       'dropRate' and 'corruptRate' are probabilities per sent packet.
+       '''
+    helloInterval = 0.1
+    handshakeInterval = 0.5
+    bootloaderTime = 1.0
+    readSize = 4096
+
+    # Values from a real gimbal's hello, the unknown one is constant
+    helloUnknown = 0x0400
+
+    def __init__(self, params=None, latency=0.0, baudrate=None, dropRate=0.0, corruptRate=0.0,
+                 seed=None, verbose=False, powerOn=True):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.dropRate = dropRate
+        self.corruptRate = corruptRate
+        self.random = random.Random(seed)
+        self.verbose = verbose
+
+        if params is None:
+            params = load_params()
+        self.mcus = [EmulatedMCU(t, [row[t] for row in params]) for t in range(3)]
+        self.version = self.mcus[0].params[0x7f]
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.state = 'off'
+        self.stateCV = threading.Condition()
+        self.boots = 0
+        self.flashTarget = 0
+        self.running = True
+        self.sendLock = threading.Lock()
+        self.outQueue = queue.Queue()
+        self.lineFree = 0
+
+        self.threads = [
+            threading.Thread(target=self._receiveLoop, daemon=True),
+            threading.Thread(target=self._transmitLoop, daemon=True),
+        ]
+        for t in self.threads:
+            t.start()
+        if powerOn:
+            self.powerCycle()
+
+    def close(self):
+        self.running = False
+        with self.stateCV:
+            self.state = 'off'
+            self.stateCV.notify_all()
+        self.outQueue.put(None)
+        os.close(self.slave)
+        os.close(self.master)
+
+    def powerCycle(self):
+        '''Reset to the bootloader, as if power was just applied'''
+        with self.stateCV:
+            self.state = 'bootloader'
+            self.boots += 1
+            self.flashTarget = 0
+            for mcu in self.mcus:
+                mcu.params = list(mcu.saved)
+                mcu.motors = 0
+            self.stateCV.notify_all()
+        threading.Thread(target=self._bootLoop, args=(self.boots,), daemon=True).start()
+
+    def _setState(self, state):
+        with self.stateCV:
+            self.state = state
+            self.stateCV.notify_all()
+
+    def _waitState(self, boot, state, timeout):
+        '''Wait for the state to change from 'state' or for another power cycle.
+           True if either happened, False on timeout.
+           '''
+        with self.stateCV:
+            return self.stateCV.wait_for(lambda: self.state != state or self.boots != boot, timeout=timeout)
+
+    def _bootLoop(self, boot):
+        # Hellos until the host claims the bootloader, or it times out
+        deadline = time.time() + self.bootloaderTime
+        while time.time() < deadline:
+            self.send(fyproto.VERSION.encode(unknown=self.helloUnknown, version=self.version))
+            if self._waitState(boot, 'bootloader', self.helloInterval):
+                return
+        with self.stateCV:
+            if self.boots != boot or self.state != 'bootloader':
+                return
+            self.state = 'handshake'
+
+        # Offer the handshake until the host acknowledges it
+        while self.running:
+            self.send(fyproto.HANDSHAKE.encode(target=3, state=0))
+            if self._waitState(boot, 'handshake', self.handshakeInterval):
+                return
+
+    def _receiveLoop(self):
+        receiver = fyproto.PacketReceiver()
+        while self.running:
+            try:
+                data = os.read(self.master, self.readSize)
+            except OSError:
+                return
+            for packet in receiver.parse(data):
+                if self.verbose:
+                    print("EMU RX %s" % packet)
+                try:
+                    self.handle(packet)
+                except (struct.error, IndexError) as e:
+                    if self.verbose:
+                        print("EMU malformed packet %s: %s" % (packet, e))
+
+    def _transmitLoop(self):
+        while True:
+            item = self.outQueue.get()
+            if item is None:
+                return
+            due, data = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                os.write(self.master, data)
+            except OSError:
+                return
+
+    def send(self, packet):
+        '''Queue a packet from the gimbal, after the configured latency
+           and behind everything already on the wire.
+           '''
+        if self.verbose:
+            print("EMU TX %s" % packet)
+        data = bytearray(packet.pack())
+        with self.sendLock:
+            if self.random.random() < self.dropRate:
+                return
+            if self.random.random() < self.corruptRate:
+                data[self.random.randrange(2, len(data))] ^= 1 << self.random.randrange(8)
+
+            start = max(time.time() + self.latency, self.lineFree)
+            if self.baudrate:
+                # 8N1 framing, ten bit times per byte
+                self.lineFree = start + len(data) * 10.0 / self.baudrate
+            else:
+                self.lineFree = start
+            self.outQueue.put((self.lineFree, bytes(data)))
+
+    def reply(self, command, data):
+        self.send(fyproto.Packet(command, target=3, data=data))
+
+    def handle(self, packet):
+        if packet.framing == fyproto.LONG_FORM:
+            self.handleBootloader(packet)
+        elif self.state == 'handshake':
+            if packet.command == 0x0b:
+                self._setState('connected')
+        elif self.state == 'connected' and packet.target < len(self.mcus):
+            self.handleApplication(self.mcus[packet.target], packet)
+
+    def handleBootloader(self, packet):
+        if packet.command == 0x01 and self.state == 'bootloader':
+            self._setState('flashing')
+            return
+        if self.state != 'flashing':
+            return
+
+        if packet.command == 0x02:
+            number, = struct.unpack('<H', packet.data[:2])
+            self.mcus[self.flashTarget].firmware[number] = packet.data[4:]
+            self.send(fyproto.Packet(0x03, fyproto.LONG_FORM, 0, struct.pack('<H', number)))
+
+        elif packet.command == 0x07:
+            self.send(fyproto.Packet(0x08, fyproto.LONG_FORM, 0, b''))
+            self.flashTarget += 1
+            if self.flashTarget == len(self.mcus):
+                # All MCUs programmed, reboot into the new firmware
+                self.powerCycle()
+
+    def handleApplication(self, mcu, packet):
+        if packet.command == 0x06:
+            number = fyproto.PARAM_GET.decode(packet).number
+            self.reply(0x06, struct.pack('<h', mcu.params[number]))
+
+        elif packet.command == 0x08:
+            m = fyproto.PARAM_SET.decode(packet)
+            mcu.params[m.number] = m.value
+
+        elif packet.command == 0x05:
+            mcu.saved = list(mcu.params)
+            self.reply(0x05, struct.pack('B', mcu.number))
+
+        elif packet.command == 0x0c:
+            slot = fyproto.CALIBRATE.decode(packet).slot
+            mcu.calibration[slot] = list(mcu.params)
+            self.reply(0x0c, packet.data)
+
+        elif packet.command == 0x03:
+            mcu.motors = fyproto.MOTORS.decode(packet).enable
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulated gimbal on a pseudo-terminal')
+    parser.add_argument('--params', metavar='FILE', help='params.txt or param-dump.py output')
+    parser.add_argument('--latency', type=float, default=0.002, help='Response latency in seconds')
+    parser.add_argument('--baudrate', type=int, default=115200, help='Limit on bytes sent, 0 for none')
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--corrupt-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    emulator = GimbalEmulator(load_params(args.params), latency=args.latency, baudrate=args.baudrate,
+        dropRate=args.drop_rate, corruptRate=args.corrupt_rate, seed=args.seed, verbose=args.verbose,
+        powerOn=False)
+    print("Emulated gimbal on %s" % emulator.port)
+    print("Press enter to power cycle, ctrl-C to quit")
+    try:
+        while True:
+            emulator.powerCycle()
+            input()
+    except (KeyboardInterrupt, EOFError):
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
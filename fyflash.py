@@ -26,7 +26,7 @@ class FirmwarePackage:
 def waitResponse(command):
     print("Waiting for %02x" % command)
     while True:
-        for packet in rx.parse(port.read(1)):
+        for packet in rx.parse(port.read(max(1, port.in_waiting))):
             if packet.framing == fyproto.LONG_FORM:
                 if packet.command == command:
                     print("RX %s" % packet)
@@ -67,7 +67,7 @@ print("Power on the gimbal now")
 
 # Look for the bootloader's "hello" announcement
 hello = waitResponse(0x00)
-_unknown, version = struct.unpack("<HH", hello.data)
+version = fyproto.VERSION.decode(hello).version
 print("Connected to version %s" % (version / 100.0))
 
 # Respond to the bootloader, prevent normal boot
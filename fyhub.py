@@ -0,0 +1,326 @@
+'''
+Many gimbals on one I/O thread.
+
+A GimbalPort normally runs its own transmit and receive threads. A
+GimbalHub runs a single selector loop instead, and every HubGimbalPort
+opened on it gets a transmitter and receiver that the loop services. Each
+port still has its own packet receiver, response queue, round-trip
+estimators and metrics, and the same blocking API as GimbalPort.
+
+    hub = GimbalHub()
+    gimbals = [hub.open(port) for port in ('/dev/ttyUSB0', '/dev/ttyUSB1')]
+    versions = hub.broadcastGetParam(target=0, number=0x7f)
+'''
+
+import os
+import queue
+import struct
+import selectors
+import functools
+import threading
+import traceback
+
+import fyproto
+import fymetrics
+import fylog
+from fyserial import GimbalPort, CoalescingQueue, Timeout
+
+
+class HubTransmitter:
+    '''Stands in for TransmitThread, the hub's loop does the writing'''
+
+    def __init__(self, hub, port, verbose=False, coalesce=False, metrics=None, recorder=None):
+        self.hub = hub
+        self.port = port
+        self.queue = CoalescingQueue() if coalesce else queue.Queue()
+        self.running = True
+        self.verbose = verbose
+        self.metrics = metrics or fymetrics.Metrics()
+        self.recorder = recorder
+        self.pending = bytearray()
+
+    def start(self):
+        self.hub._register(self)
+
+    def join(self):
+        pass
+
+    def fill(self):
+        '''Move queued packets into the pending output buffer'''
+        while True:
+            try:
+                p = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if self.verbose:
+                print("TX %s" % p)
+            frame = p.pack()
+            self.pending += frame
+            self.metrics.count('tx.packets.cmd%02x' % p.command)
+            self.metrics.count('tx.bytes.cmd%02x' % p.command, len(frame))
+
+    def flush(self, fd):
+        '''Write as much as the port accepts. True if everything went out.'''
+        self.fill()
+        if self.pending:
+            try:
+                written = os.write(fd, self.pending)
+            except BlockingIOError:
+                written = 0
+            if self.recorder and written:
+                self.recorder.record(fylog.TX, memoryview(self.pending)[:written])
+            del self.pending[:written]
+            self.metrics.count('tx.writes')
+        return not self.pending
+
+
+class HubReceiver:
+    '''Stands in for ReceiverThread, the hub's loop does the reading'''
+    receiverClass = fyproto.PacketReceiver
+    readSize = 4096
+
+    def __init__(self, hub, port, callback, verbose=False, metrics=None, recorder=None):
+        self.hub = hub
+        self.port = port
+        self.callback = callback
+        self.running = True
+        self.verbose = verbose
+        self.metrics = metrics or fymetrics.Metrics()
+        self.recorder = recorder
+        self.receiver = self.receiverClass()
+
+    def start(self):
+        self.hub._register(self)
+
+    def join(self):
+        self.hub._unregister(self)
+
+    def read(self, fd):
+        try:
+            data = os.read(fd, self.readSize)
+        except BlockingIOError:
+            return
+        if not data:
+            raise IOError("End of file, the device is gone")
+        self.metrics.count('rx.bytes', len(data))
+        if self.recorder:
+            self.recorder.record(fylog.RX, data)
+        for packet in self.receiver.parse(data):
+            if self.verbose:
+                print("RX %s" % packet)
+            self.metrics.count('rx.packets.cmd%02x' % packet.command)
+            self.metrics.count('rx.bytes.cmd%02x' % packet.command, packet.packed_size())
+            try:
+                self.callback(packet)
+            except:
+                traceback.print_exc()
+
+
+class HubGimbalPort(GimbalPort):
+    '''GimbalPort whose I/O is done by a GimbalHub, see GimbalHub.open().
+       If reading or writing the port fails, the hub stops servicing it and
+       records the error in 'failed', and sending anything more raises IOError.
+       '''
+
+    def __init__(self, hub, *args, **kw):
+        self.hub = hub
+        self.failed = None
+        self.transmitThreadClass = functools.partial(HubTransmitter, hub)
+        self.receiverThreadClass = functools.partial(HubReceiver, hub)
+        GimbalPort.__init__(self, *args, **kw)
+
+    def send(self, packet):
+        if self.failed:
+            raise IOError("Port failed: %s" % self.failed)
+        GimbalPort.send(self, packet)
+        self.hub.wake(self.tx)
+
+    def close(self):
+        self.hub._forget(self)
+        GimbalPort.close(self)
+
+
+class Endpoint:
+    '''One port's file descriptor, with its transmitter and receiver'''
+    def __init__(self, fd):
+        self.fd = fd
+        self.tx = None
+        self.rx = None
+
+
+class GimbalHub(threading.Thread):
+    '''One selector loop servicing any number of HubGimbalPorts'''
+    portClass = HubGimbalPort
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.selector = selectors.DefaultSelector()
+        self.ports = []
+        self.endpoints = {}
+        self.running = True
+        self.lock = threading.Lock()
+        self.changes = []
+        self.dirty = set()
+        self.woken = False
+        self.wakeRead, self.wakeWrite = os.pipe()
+        os.set_blocking(self.wakeRead, False)
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
+        self.setDaemon(True)
+        self.start()
+
+    def open(self, *args, **kw):
+        '''New HubGimbalPort, with the same arguments as GimbalPort'''
+        port = self.portClass(self, *args, **kw)
+        with self.lock:
+            self.ports.append(port)
+        return port
+
+    def close(self):
+        for port in list(self.ports):
+            port.close()
+        self.running = False
+        self.wake()
+        self.join()
+        self.selector.close()
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+    def wake(self, tx=None):
+        '''Interrupt the selector, to pick up registration changes, and packets queued on 'tx'.'''
+        with self.lock:
+            if tx is not None:
+                self.dirty.add(tx)
+            if self.woken:
+                return
+            self.woken = True
+        os.write(self.wakeWrite, b'\x00')
+
+    def _change(self, item, add):
+        # Registration happens on the loop's thread, wait until it's done
+        done = threading.Event()
+        with self.lock:
+            self.changes.append((item, add, done))
+        self.wake()
+        done.wait()
+
+    def _register(self, item):
+        self._change(item, True)
+
+    def _unregister(self, rx):
+        self._change(rx, False)
+
+    def _forget(self, port):
+        with self.lock:
+            self.ports = [p for p in self.ports if p is not port]
+
+    def _applyChanges(self):
+        with self.lock:
+            changes, self.changes = self.changes, []
+            dirty, self.dirty = self.dirty, set()
+            self.woken = False
+        for item, add, done in changes:
+            fd = item.port.fileno()
+            if add:
+                endpoint = self.endpoints.get(fd)
+                if endpoint is None:
+                    os.set_blocking(fd, False)
+                    endpoint = self.endpoints[fd] = Endpoint(fd)
+                    self.selector.register(fd, selectors.EVENT_READ, endpoint)
+                if isinstance(item, HubTransmitter):
+                    endpoint.tx = item
+                else:
+                    endpoint.rx = item
+            elif fd in self.endpoints:
+                self.selector.unregister(fd)
+                del self.endpoints[fd]
+            done.set()
+        for endpoint in list(self.endpoints.values()):
+            if endpoint.tx in dirty:
+                self._flush(endpoint)
+
+    def _flush(self, endpoint):
+        if endpoint.tx is None:
+            return
+        events = selectors.EVENT_READ
+        try:
+            if not endpoint.tx.flush(endpoint.fd):
+                events |= selectors.EVENT_WRITE
+        except OSError as e:
+            self._fail(endpoint, e)
+            return
+        if self.selector.get_key(endpoint.fd).events != events:
+            self.selector.modify(endpoint.fd, events, endpoint)
+
+    def _fail(self, endpoint, error):
+        '''Stop servicing a port that can't be read or written, and keep serving the rest'''
+        self.selector.unregister(endpoint.fd)
+        del self.endpoints[endpoint.fd]
+        with self.lock:
+            ports = [p for p in self.ports if p.rx is endpoint.rx or p.tx is endpoint.tx]
+        for port in ports:
+            port.failed = error
+            port.metrics.count('port.failures')
+            if port.verbose:
+                print("Port failed: %s" % error)
+
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select():
+                endpoint = key.data
+                if endpoint is None:
+                    try:
+                        os.read(self.wakeRead, 4096)
+                    except BlockingIOError:
+                        pass
+                    self._applyChanges()
+                    continue
+                if events & selectors.EVENT_READ and endpoint.rx:
+                    try:
+                        endpoint.rx.read(endpoint.fd)
+                    except OSError as e:
+                        self._fail(endpoint, e)
+                        continue
+                if events & selectors.EVENT_WRITE and endpoint.fd in self.endpoints:
+                    self._flush(endpoint)
+
+    def broadcastTransaction(self, packet, ports=None, timeout=None, retries=None):
+        '''Send the same request to every port at once, and return their
+           responses in port order. Ports that don't answer the first
+           attempt are retried on their own, as in GimbalPort.transaction().
+           '''
+        ports = list(self.ports if ports is None else ports)
+        responses = [None] * len(ports)
+        locked = []
+        try:
+            for port in ports:
+                port.waitConnect()
+                port._transactionLock.acquire()
+                locked.append(port)
+            for port in ports:
+                port._drainResponses(0)
+                port.send(packet)
+            for i, port in enumerate(ports):
+                attemptTimeout = port.roundTrip(packet.target).timeout() if timeout is None else timeout
+                try:
+                    responses[i] = port._waitResponse(packet.command, timeout=attemptTimeout)
+                except Timeout:
+                    port.metrics.count('transaction.timeouts')
+                    port.roundTrip(packet.target).backoff()
+                    port._drainResponses(port.lateResponseTimeout([port.roundTrip(packet.target)]))
+        finally:
+            for port in locked:
+                port._transactionLock.release()
+        for i, port in enumerate(ports):
+            if responses[i] is None:
+                responses[i] = port.transaction(packet, timeout=timeout, retries=retries)
+        return responses
+
+    def broadcastGetParam(self, target, number, fmt='h', ports=None, timeout=None, retries=None):
+        '''Read one param from every port at once, returns a list of values'''
+        p = fyproto.Packet(target=target, command=0x06, data=struct.pack('B', number))
+        return [struct.unpack('<' + fmt, r.data)[0]
+            for r in self.broadcastTransaction(p, ports=ports, timeout=timeout, retries=retries)]
+
+    def broadcastSetParam(self, target, number, value, fmt='h', ports=None):
+        for port in (self.ports if ports is None else ports):
+            port.setParam(target, number, value, fmt=fmt)
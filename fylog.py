@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+'''
+Binary packet logs, recorded by GimbalPort with record='filename'.
+(No serial port dependency)
+
+The log holds what the port actually read and wrote: each record is one
+read or write call's raw bytes, with a direction and a monotonic
+nanosecond timestamp. Nothing is decoded or re-encoded while recording,
+which costs one buffered write per call regardless of link rate. Packets
+are split back out when the log is read, and take the timestamp of the
+record they end in.
+
+    filename          header, then records: <time_ns q> <direction B> <length I> <bytes>
+    filename.idx      (time_ns, offset) of a record roughly every 'indexInterval' bytes
+
+The reader memory-maps the log and uses the index to start near a time,
+so a slice of a large log can be read without touching the rest.
+'''
+
+import mmap
+import time
+import bisect
+import struct
+import argparse
+import threading
+import collections
+
+import fyproto
+
+MAGIC = b'FYLOG\x00\x01\x00'
+
+# Magic, then monotonic and wall clock nanoseconds at the same instant
+HEADER_STRUCT = struct.Struct('<8sqq')
+RECORD_STRUCT = struct.Struct('<qBI')
+INDEX_STRUCT = struct.Struct('<qQ')
+
+DIRECTIONS = ('rx', 'tx')
+RX, TX = 0, 1
+
+LogRecord = collections.namedtuple('LogRecord', 'time direction packet')
+
+
+class PacketRecorder:
+    '''Appends raw port traffic to a new binary log'''
+    indexInterval = 64 * 1024
+    bufferSize = 256 * 1024
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.file = open(filename, 'wb', buffering=self.bufferSize)
+        self.indexFile = open(filename + '.idx', 'wb')
+        self.file.write(HEADER_STRUCT.pack(MAGIC, time.monotonic_ns(), time.time_ns()))
+        self.offset = HEADER_STRUCT.size
+        self.nextIndex = self.offset
+
+    def record(self, direction, data):
+        '''Log one read (RX) or write (TX)'''
+        t = time.monotonic_ns()
+        with self.lock:
+            if self.offset >= self.nextIndex:
+                self.indexFile.write(INDEX_STRUCT.pack(t, self.offset))
+                self.nextIndex = self.offset + self.indexInterval
+            self.file.write(RECORD_STRUCT.pack(t, direction, len(data)))
+            self.file.write(data)
+            self.offset += RECORD_STRUCT.size + len(data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.indexFile.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.indexFile.close()
+
+
+class PacketLog:
+    '''Memory-mapped reader for a binary packet log'''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.monotonicStart, self.wallStart = HEADER_STRUCT.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError("Not a packet log: %r" % filename)
+
+        try:
+            with open(filename + '.idx', 'rb') as f:
+                index = list(INDEX_STRUCT.iter_unpack(f.read()))
+        except FileNotFoundError:
+            index = []
+        index = index or [(None, HEADER_STRUCT.size)]
+        self.indexTimes = [t for t, offset in index]
+        self.indexOffsets = [offset for t, offset in index]
+
+    def close(self):
+        self.map.close()
+
+    def _seek(self, start):
+        '''Offset of the last indexed record at or before time 'start' '''
+        if start is None or self.indexTimes[0] is None:
+            return HEADER_STRUCT.size
+        i = bisect.bisect_right(self.indexTimes, start) - 1
+        return self.indexOffsets[max(0, i)]
+
+    def _scan(self, offset, end):
+        view = memoryview(self.map)
+        size = len(self.map)
+        while offset + RECORD_STRUCT.size <= size:
+            t, direction, length = RECORD_STRUCT.unpack_from(self.map, offset)
+            offset += RECORD_STRUCT.size
+            if offset + length > size:
+                # Recording was cut off part way through a record
+                break
+            if end is not None and t >= end:
+                break
+            yield t, direction, view[offset:offset+length]
+            offset += length
+
+    def records(self, start=None, end=None):
+        '''(time, direction, bytes) for each raw record in [start, end),
+           with times in monotonic nanoseconds. Bytes are memoryviews into the log.
+           '''
+        for record in self._scan(self._seek(start), end):
+            if start is None or record[0] >= start:
+                yield record
+
+    def packets(self, start=None, end=None):
+        '''LogRecords for the packets in [start, end), timed by the record they end in.
+           Reading starts from the index point before 'start', so packets that
+           straddle it are still found.
+           '''
+        receivers = [fyproto.PacketReceiver() for d in DIRECTIONS]
+        for t, direction, data in self._scan(self._seek(start), end):
+            for packet in receivers[direction].parse(data):
+                if start is None or t >= start:
+                    yield LogRecord(t, DIRECTIONS[direction], packet)
+
+    def wallTime(self, t):
+        '''Wall clock seconds for a monotonic nanosecond timestamp from this log'''
+        return (self.wallStart + (t - self.monotonicStart)) / 1e9
+
+
+def main():
+    # Print a log as a text trace, in the format fytrace reads
+    parser = argparse.ArgumentParser(description='Dump a binary packet log as text')
+    parser.add_argument('--start', type=float, help='Seconds from the start of the log')
+    parser.add_argument('--end', type=float, help='Seconds from the start of the log')
+    parser.add_argument('--times', action='store_true', help='Prefix each line with its time in seconds')
+    parser.add_argument('filename')
+    args = parser.parse_args()
+
+    log = PacketLog(args.filename)
+    origin = log.monotonicStart
+    start = None if args.start is None else origin + int(args.start * 1e9)
+    end = None if args.end is None else origin + int(args.end * 1e9)
+    for record in log.packets(start, end):
+        line = "%s %s" % (record.direction.upper(), record.packet)
+        if args.times:
+            line = "%.6f %s" % ((record.time - origin) / 1e9, line)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
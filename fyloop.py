@@ -0,0 +1,108 @@
+'''
+Fixed-rate control loops, scheduled against absolute deadlines
+(No serial port dependency)
+
+Sleeping for a period between cycles makes a loop run slower than its
+rate by however long each cycle takes, and any blocking inside the cycle
+adds jitter. A ControlLoop instead keeps a grid of deadlines one period
+apart on the monotonic clock, and only sleeps for what's left until the
+next one.
+
+    loop = ControlLoop(hz=75, metrics=gimbal.metrics, name='controller')
+    loop.run(step)
+
+Control code should read telemetry with TelemetrySubscription.latest()
+rather than waiting for a fresh sample, so a slow serial response delays
+the next reading instead of the next setpoint.
+'''
+
+import time
+
+import fymetrics
+
+
+class ControlLoop:
+    '''Calls to tick() return once per period, on absolute deadlines.
+
+       When a cycle overruns, 'overrun' decides what happens to the
+       deadlines it missed:
+
+           'skip'      Drop them and carry on from the latest deadline
+                       on the grid, so the loop never bursts.
+           'catchup'   Run a cycle for each of them, back to back, until
+                       the loop is on schedule again.
+
+       A cycle that starts less than a period late is not an overrun, it
+       just counts as jitter. Each cycle records '<name>.jitter', how late
+       it started, and '<name>.latency', how long it ran, as histograms in
+       'metrics', along with '<name>.cycles', '<name>.overruns' and
+       '<name>.skipped' counters.
+
+       'hz' can be changed at any time, and takes effect from the next deadline.
+       '''
+    clock = staticmethod(time.monotonic)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, hz, overrun='skip', metrics=None, name='loop'):
+        if overrun not in ('skip', 'catchup'):
+            raise ValueError("Unknown overrun policy %r" % overrun)
+        self.hz = hz
+        self.overrun = overrun
+        self.metrics = metrics or fymetrics.Metrics()
+        self.name = name
+        self.running = True
+        self.deadline = None
+        self.started = None
+
+    def tick(self):
+        '''End the current cycle, if any, and wait for the next one's deadline.
+           Returns that deadline, in monotonic seconds.
+           '''
+        now = self.clock()
+        if self.started is not None:
+            self.metrics.observe(self.name + '.latency', now - self.started)
+
+        period = 1.0 / self.hz
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += period
+            missed = int((now - self.deadline) / period)
+            if missed > 0:
+                self.metrics.count(self.name + '.overruns')
+                if self.overrun == 'skip':
+                    self.deadline += missed * period
+                    self.metrics.count(self.name + '.skipped', missed)
+
+        delay = self.deadline - now
+        if delay > 0:
+            self.sleep(delay)
+        self.started = self.clock()
+        self.metrics.observe(self.name + '.jitter', max(0.0, self.started - self.deadline))
+        self.metrics.count(self.name + '.cycles')
+        return self.deadline
+
+    def run(self, step):
+        '''Call step() once per cycle until stop()'''
+        self.running = True
+        while self.running:
+            self.tick()
+            step()
+        self.reset()
+
+    def stop(self):
+        self.running = False
+
+    def reset(self):
+        '''Forget the schedule, so the next tick() starts a new one without counting the gap'''
+        self.started = None
+        self.deadline = None
+
+    def stats(self):
+        '''Cycle counters and jitter/latency percentiles, from a snapshot of the metrics'''
+        snapshot = self.metrics.snapshot()
+        prefix = self.name + '.'
+        return {
+            'counters': { k: v for k, v in snapshot['counters'].items() if k.startswith(prefix) },
+            'latency': { k: v for k, v in snapshot['latency'].items() if k.startswith(prefix) },
+        }
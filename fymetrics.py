@@ -0,0 +1,102 @@
+'''
+Runtime counters and latency histograms for the serial link
+(No serial port dependency)
+'''
+
+import bisect
+import collections
+import threading
+
+
+class Histogram:
+    '''Latency histogram with logarithmic buckets, so percentiles can be
+       read at any time without keeping every sample. Buckets grow by
+       'ratio' from 'low' seconds, values outside the range are clamped.
+       '''
+    def __init__(self, low=1e-5, high=100.0, ratio=2 ** 0.25):
+        self.bounds = []
+        bound = low
+        while bound < high:
+            self.bounds.append(bound)
+            bound *= ratio
+        self.bounds.append(high)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[min(bisect.bisect_left(self.bounds, value), len(self.bounds) - 1)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        '''Upper bound of the bucket holding the p'th percentile (0-100)'''
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.count and self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Metrics:
+    '''Named counters, latency histograms and gauges.
+
+       Names are dotted strings, like 'tx.packets.cmd08'. Gauges are
+       functions called whenever a snapshot is taken, for values that
+       already live elsewhere, like a queue depth.
+       '''
+    histogramClass = Histogram
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = self.histogramClass()
+            h.add(value)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        '''Current values, as a dictionary that can be serialized to JSON'''
+        with self.lock:
+            result = {
+                'counters': dict(self.counters),
+                'latency': { name: h.snapshot() for name, h in self.histograms.items() },
+            }
+        result['gauges'] = { name: fn() for name, fn in self.gauges.items() }
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
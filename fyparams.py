@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''
+Parameter schema, generated from the annotations in params.txt
+(No serial port dependency)
+
+Each line of params.txt holds the per-axis values read from a working
+gimbal, then a comment with the param number, an optional staleness class
+and an optional description:
+
+    [0, -3754, -296],                  # 0x09  dynamic  |       Gyro angle reading
+
+Staleness classes:
+    dynamic   Changes on its own, like sensor readings
+    rw        Written by both the host and the gimbal's own control loops
+    init      Set while the gimbal starts up or connects
+    static    Configuration, only changes when the host writes it
+              (any param without an annotation)
+'''
+
+import os
+import re
+import ast
+import json
+import collections
+
+LINE_PATTERN = re.compile(
+    r'^(?P<values>\[[^\]]*\]),?\s*#\s*0x(?P<number>[0-9a-fA-F]{2})\s+(?P<staleness>\w*)\s*\|\s*(?P<description>.*)$')
+
+DEFAULT_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'params.txt')
+
+ParamInfo = collections.namedtuple('ParamInfo', 'number staleness values description')
+
+_schemas = {}
+
+
+def parse_schema(lines):
+    '''Dictionary of ParamInfo keyed on param number, from params.txt lines'''
+    schema = {}
+    for line in lines:
+        m = LINE_PATTERN.match(line.strip())
+        if m:
+            number = int(m.group('number'), 16)
+            schema[number] = ParamInfo(
+                number=number,
+                staleness=m.group('staleness') or 'static',
+                values=tuple(ast.literal_eval(m.group('values'))),
+                description=m.group('description').strip())
+    return schema
+
+
+def load_schema(filename=None):
+    '''Schema for a params.txt file, parsed once and then shared'''
+    filename = filename or DEFAULT_FILENAME
+    if filename not in _schemas:
+        with open(filename) as f:
+            _schemas[filename] = parse_schema(f)
+    return _schemas[filename]
+
+
+def main():
+    # Dump the schema as JSON, for tools outside Python
+    schema = load_schema()
+    print(json.dumps({'0x%02x' % n: info._asdict() for n, info in sorted(schema.items())}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
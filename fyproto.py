@@ -3,8 +3,16 @@ Low level Feiyu Gimbal protocol encoding and decoding
 (No serial port dependency)
 '''
 
+import re
 import struct
 import binascii
+import collections
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for bulk decoding of whole captures
+    numpy = None
 
 LONG_FORM = 0xaa55
 SHORT_FORM = 0x5aa5
@@ -27,10 +35,26 @@ SHORT_FORM = 0x5aa5
 #   cmd0c  Capture center angles
 #   cmd0d  IMU data?
 
+# Precompiled codecs, shared by every packet. Headers exclude the sync word,
+# matching the bytes covered by the CRC. Frame structs include it.
+FRAMING_STRUCT = struct.Struct('<H')
+CRC_STRUCT = struct.Struct('<H')
+LONG_HEADER_STRUCT = struct.Struct('<BBH')
+SHORT_HEADER_STRUCT = struct.Struct('<BBB')
+LONG_FRAME_STRUCT = struct.Struct('<HBBH')
+SHORT_FRAME_STRUCT = struct.Struct('<HBBB')
+
+
 class Packet:
+    __slots__ = ('command', 'framing', 'target', 'data')
+
     formats = {
-        LONG_FORM: { 'len_struct': 'H', 'initial_crc_value': 0xffff },
-        SHORT_FORM: { 'len_struct': 'B', 'initial_crc_value': 0x0000 },
+        LONG_FORM: { 'initial_crc_value': 0xffff, 'sync': FRAMING_STRUCT.pack(LONG_FORM),
+                     'header_struct': LONG_HEADER_STRUCT,
+                     'frame_struct': LONG_FRAME_STRUCT },
+        SHORT_FORM: { 'initial_crc_value': 0x0000, 'sync': FRAMING_STRUCT.pack(SHORT_FORM),
+                      'header_struct': SHORT_HEADER_STRUCT,
+                      'frame_struct': SHORT_FRAME_STRUCT },
     }
 
     def __init__(self, command, framing=SHORT_FORM, target=0, data=b''):
@@ -53,48 +77,346 @@ class Packet:
     def format_option(self, name, default=None):
         return self.formats[self.framing].get(name, default)
 
+    def packed_size(self):
+        return self.formats[self.framing]['frame_struct'].size + len(self.data) + CRC_STRUCT.size
+
+    def pack_into(self, buffer, offset=0):
+        '''Encode this packet into a writable buffer at 'offset'.
+           Returns the number of bytes written.
+
+           Packets are a few bytes long, so this is a copy of pack()'s
+           result; writing fields into the buffer in place costs more in
+           struct and slicing overhead than the allocation it saves.
+           '''
+        frame = self.pack()
+        buffer[offset:offset + len(frame)] = frame
+        return len(frame)
+
     def pack(self):
-        parts = [
-            struct.pack('BB', self.target, self.command),
-            struct.pack('<' + self.format_option('len_struct'), len(self.data)),
-            self.data
-        ]
-        parts.append(struct.pack('<H', self.crc(self.framing, b''.join(parts))))
-        return struct.pack('<H', self.framing) + b''.join(parts)
+        options = self.formats[self.framing]
+        header = options['header_struct'].pack(self.target, self.command, len(self.data))
+        crc = binascii.crc_hqx(self.data, binascii.crc_hqx(header, options['initial_crc_value']))
+        return b''.join((options['sync'], header, self.data, CRC_STRUCT.pack(crc)))
 
 
 class PacketReceiver:
     packetClass = Packet
 
+    # Consumed bytes are only discarded from the front of the buffer once
+    # there are at least this many of them, and they outnumber the unconsumed
+    # bytes. This keeps compaction cost linear in the bytes received.
+    compactThreshold = 4096
+
     def __init__(self):
-        self.buffer = b''
+        self.buffer = bytearray()
+        self.offset = 0
+        # Link health counters, never reset by the receiver
+        self.crcErrors = 0
+        self.resyncBytes = 0
+        self.syncPattern = re.compile(b'|'.join(
+            re.escape(struct.pack('<H', f)) for f in self.packetClass.formats))
+
+    def __len__(self):
+        '''Number of received bytes not yet consumed by the parser'''
+        return len(self.buffer) - self.offset
+
+    def _compact(self):
+        if self.offset >= self.compactThreshold and self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
 
     def parse(self, data):
         '''Yields a list of Packet instances, from 'data' or prior bytes.'''
         self.buffer += data
-        while len(self.buffer) >= 2:
-            framing = struct.unpack('<H', self.buffer[:2])[0]
+        buf = self.buffer
+        while len(buf) - self.offset >= 2:
+            start = self.offset
+            framing = buf[start] | (buf[start + 1] << 8)
             if framing not in self.packetClass.formats:
-                self.buffer = self.buffer[1:]
+                # Skip ahead to the next sync word of any framing type. If there
+                # isn't one, keep only the last byte, it may begin a sync word.
+                sync = self.syncPattern.search(buf, start + 1)
+                self.offset = sync.start() if sync else len(buf) - 1
+                self.resyncBytes += self.offset - start
                 continue
 
-            header_format = '<BB' + self.packetClass.formats[framing]['len_struct']
-            header_len = struct.calcsize(header_format)
-            header = self.buffer[2:2+header_len]
-            if len(self.buffer) < header_len + 4:
+            header_struct = self.packetClass.formats[framing]['header_struct']
+            header_len = header_struct.size
+            if len(buf) - start < header_len + 4:
                 break
-            target, command, data_len = struct.unpack(header_format, header)
+            target, command, data_len = header_struct.unpack_from(buf, start + 2)
 
-            if len(self.buffer) < header_len + data_len + 4:
+            end = start + header_len + data_len + 4
+            if len(buf) < end:
                 break
-            data = self.buffer[2+header_len:2+header_len+data_len]
-            rx_crc = struct.unpack('<H', self.buffer[2+header_len+data_len:4+header_len+data_len])[0]
-            self.buffer = self.buffer[4+header_len+data_len:]
+            data = bytes(buf[start+2+header_len:end-2])
+            rx_crc = buf[end-2] | (buf[end-1] << 8)
+            calc_crc = self.packetClass.crc(framing, memoryview(buf)[start+2:end-2])
+            self.offset = end
 
-            calc_crc = self.packetClass.crc(framing, header + data)
             if rx_crc != calc_crc:
+                self.crcErrors += 1
                 print("CRC mismatch, received %04x and expected %04x" % (rx_crc, calc_crc))
                 continue
 
-            yield Packet(command, framing, target, data)
+            yield self.packetClass(command, framing, target, data)
+
+        self._compact()
+
+
+# decode_buffer() only checks CRCs in batch when there are at least this many
+# same-length candidates per byte of CRC input
+_batchCrcRatio = 16
+
+
+def _crc_table(poly=0x1021):
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ poly) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xffff)
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+class PacketBatch:
+    '''Columnar view of all packets found in a buffer by decode_buffer().
+
+       Each attribute is a NumPy array with one entry per packet:
+       offset (of the sync word), framing, target, command, length,
+       and payload_offset. Payload bytes stay in 'buffer' until requested.
+       '''
+    packetClass = Packet
+    columns = ('offset', 'framing', 'target', 'command', 'length', 'payload_offset')
+
+    def __init__(self, buffer, **columns):
+        self.buffer = buffer
+        for name in self.columns:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __getitem__(self, index):
+        '''Integer index returns a Packet, anything else selects a sub-batch'''
+        if isinstance(index, (int, numpy.integer)):
+            return self.packet(index)
+        return self.__class__(self.buffer, **{name: getattr(self, name)[index] for name in self.columns})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.packet(i)
+
+    def payload(self, index):
+        start = int(self.payload_offset[index])
+        return bytes(self.buffer[start:start + int(self.length[index])])
+
+    def packet(self, index):
+        return self.packetClass(int(self.command[index]), int(self.framing[index]),
+            int(self.target[index]), self.payload(index))
+
+    def select(self, framing=None, target=None, command=None, length=None):
+        '''Sub-batch of the packets matching all given header fields'''
+        mask = numpy.ones(len(self), dtype=bool)
+        for name, value in (('framing', framing), ('target', target),
+                            ('command', command), ('length', length)):
+            if value is not None:
+                mask &= getattr(self, name) == value
+        return self[mask]
+
+    def payloads(self, length=None):
+        '''2-D uint8 array of payload bytes, for packets of equal length'''
+        if length is None:
+            lengths = numpy.unique(self.length)
+            if len(lengths) > 1:
+                raise ValueError('Payload lengths differ, select() a single length first')
+            length = int(lengths[0]) if len(lengths) else 0
+        data = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        return data[self.payload_offset[:, None] + numpy.arange(length)]
+
+
+def decode_buffer(buffer, batchClass=PacketBatch):
+    '''Find every valid packet in a complete capture, in a few vectorized passes.
+
+       Unlike PacketReceiver, candidates that fail their CRC are dropped
+       without consuming their claimed length, so a corrupted header can't
+       hide the packets after it. Where valid packets overlap, the earliest
+       one wins, matching the order a stream parser would see them in.
+       Requires NumPy. Returns a PacketBatch.
+       '''
+    if numpy is None:
+        raise ImportError('decode_buffer() requires NumPy')
+
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    table = numpy.array(CRC_TABLE, dtype=numpy.uint16)
+    size = len(data)
+    found = []
+
+    for framing, options in batchClass.packetClass.formats.items():
+        header_len = options['header_struct'].size
+        sync = struct.pack('<H', framing)
+        offsets = numpy.flatnonzero((data[:-1] == sync[0]) & (data[1:] == sync[1]))
+        offsets = offsets[offsets + header_len + 4 <= size]
+
+        # Length field follows target and command, little endian
+        length = data[offsets + 4].astype(numpy.int64)
+        if header_len == 4:
+            length = length | (data[offsets + 5].astype(numpy.int64) << 8)
+        end = offsets + header_len + length + 4
+        keep = end <= size
+        offsets, length, end = offsets[keep], length[keep], end[keep]
+
+        # CRC covers header and payload. Table-driven CRC-16, run over every
+        # candidate of the same length at once, one byte column per step.
+        # Each column step costs about as much as a few dozen single-packet
+        # CRCs, so long payloads or rare lengths (usually false sync words in
+        # random payload data) are cheaper to check one at a time.
+        valid = numpy.zeros(len(offsets), dtype=bool)
+        rx_crc = data[end - 2].astype(numpy.uint16) | (data[end - 1].astype(numpy.uint16) << 8)
+        for crc_len in numpy.unique(length):
+            group = numpy.flatnonzero(length == crc_len)
+            start = offsets[group] + 2
+            span = header_len + int(crc_len)
+            if len(group) < span * _batchCrcRatio:
+                crc = [binascii.crc_hqx(buffer[s:s + span], options['initial_crc_value'])
+                       for s in start.tolist()]
+            else:
+                crc = numpy.full(len(group), options['initial_crc_value'], dtype=numpy.uint16)
+                for i in range(span):
+                    crc = (crc << 8) ^ table[(crc >> 8) ^ data[start + i]]
+            valid[group] = crc == rx_crc[group]
+
+        offsets, length, end = offsets[valid], length[valid], end[valid]
+        found.append((offsets, numpy.full(len(offsets), framing, dtype=numpy.uint16),
+            length, end, header_len))
+
+    offsets = numpy.concatenate([f[0] for f in found])
+    framing = numpy.concatenate([f[1] for f in found])
+    length = numpy.concatenate([f[2] for f in found])
+    end = numpy.concatenate([f[3] for f in found])
+    payload_offset = numpy.concatenate([f[0] + 2 + f[4] for f in found])
+    order = numpy.argsort(offsets, kind='stable')
+    offsets, framing, length, end, payload_offset = (
+        offsets[order], framing[order], length[order], end[order], payload_offset[order])
+
+    # Overlap is rare in real captures (a sync word inside a valid payload
+    # with a matching CRC) so only resolve it the slow way when present.
+    if len(offsets) > 1 and numpy.any(offsets[1:] < end[:-1]):
+        keep = numpy.zeros(len(offsets), dtype=bool)
+        cursor = 0
+        for i, (start, stop) in enumerate(zip(offsets.tolist(), end.tolist())):
+            if start >= cursor:
+                keep[i] = True
+                cursor = stop
+        offsets, framing, length, payload_offset = (
+            offsets[keep], framing[keep], length[keep], payload_offset[keep])
+
+    return batchClass(buffer,
+        offset=offsets,
+        framing=framing,
+        target=data[offsets + 2],
+        command=data[offsets + 3],
+        length=length,
+        payload_offset=payload_offset)
+
+
+class Message:
+    '''Typed layout of one kind of packet payload.
+
+       A message is identified by framing, command and payload length,
+       since requests and responses can share a command number.
+       Fields are (name, struct code) pairs, always little endian.
+       '''
+    # Struct codes to NumPy scalar types, for structured array output
+    dtypes = { 'b': 'i1', 'B': 'u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4' }
+
+    def __init__(self, name, framing, command, fields):
+        self.name = name
+        self.framing = framing
+        self.command = command
+        self.fields = fields
+        self.struct = struct.Struct('<' + ''.join(code for _, code in fields))
+        self.tuple = collections.namedtuple(name, [field for field, _ in fields])
+
+    def __repr__(self):
+        return '<Message %s %04X cmd=%02x len=%d>' % (self.name, self.framing, self.command, self.length)
+
+    @property
+    def length(self):
+        return self.struct.size
+
+    def matches(self, packet):
+        return (packet.framing == self.framing and packet.command == self.command
+            and len(packet.data) == self.length)
+
+    def decode(self, packet):
+        '''Unpack one packet's payload into a named tuple'''
+        return self.tuple._make(self.struct.unpack(packet.data))
+
+    def encode(self, target=0, **values):
+        '''Build a Packet with this message's payload'''
+        data = self.struct.pack(*(values[field] for field, _ in self.fields))
+        return Packet(self.command, self.framing, target, data)
+
+    def dtype(self):
+        return numpy.dtype([(field, self.dtypes[code]) for field, code in self.fields])
+
+    def decode_batch(self, batch):
+        '''Structured array with one row per matching packet in a PacketBatch.
+           Rows also carry the packet's 'offset' and 'target' columns.
+           '''
+        batch = batch.select(framing=self.framing, command=self.command, length=self.length)
+        payload_dtype = self.dtype()
+        result = numpy.empty(len(batch), dtype=[('offset', '<i8'), ('target', 'u1')] + payload_dtype.descr)
+        result['offset'] = batch.offset
+        result['target'] = batch.target
+        values = batch.payloads(self.length).view(payload_dtype).reshape(-1)
+        for field in payload_dtype.names:
+            result[field] = values[field]
+        return result
+
+
+# Known messages, keyed on (framing, command), then payload length
+messages = {}
+
+def register_message(message):
+    messages.setdefault((message.framing, message.command), {})[message.length] = message
+    return message
+
+def find_message(packet):
+    '''Message type for a Packet, or None if its payload layout is unknown'''
+    return messages.get((packet.framing, packet.command), {}).get(len(packet.data))
+
+def decode_message(packet):
+    '''Named tuple for a Packet's payload, or None if its layout is unknown'''
+    message = find_message(packet)
+    return message and message.decode(packet)
+
+def decode_batch(batch):
+    '''Structured arrays for every known message type present in a PacketBatch,
+       as a dictionary keyed on message name.
+       '''
+    results = {}
+    for by_length in messages.values():
+        for message in by_length.values():
+            decoded = message.decode_batch(batch)
+            if len(decoded):
+                results[message.name] = decoded
+    return results
+
+
+VERSION = register_message(Message('version', LONG_FORM, 0x00, [('unknown', 'H'), ('version', 'H')]))
+CONTROL = register_message(Message('control', SHORT_FORM, 0x01, [('x', 'h'), ('y', 'h'), ('z', 'h'), ('mode', 'B')]))
+MOTORS = register_message(Message('motors', SHORT_FORM, 0x03, [('enable', 'B')]))
+SAVE = register_message(Message('save', SHORT_FORM, 0x05, [('mcu', 'B')]))
+PARAM_GET = register_message(Message('param_get', SHORT_FORM, 0x06, [('number', 'B')]))
+PARAM_VALUE = register_message(Message('param_value', SHORT_FORM, 0x06, [('value', 'h')]))
+PARAM_SET = register_message(Message('param_set', SHORT_FORM, 0x08, [('number', 'B'), ('reserved', 'B'), ('value', 'h')]))
+HANDSHAKE = register_message(Message('handshake', SHORT_FORM, 0x0b, [('state', 'B')]))
+CALIBRATE = register_message(Message('calibrate', SHORT_FORM, 0x0c, [('slot', 'B')]))
 
+# Field meanings are a guess: a sign-extended 32-bit reading then two small
+# values that are almost always zero.
+STREAM = register_message(Message('stream', SHORT_FORM, 0x0d, [('value', 'i'), ('aux', 'h'), ('flags', 'B')]))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+'''
+Replay recorded packet traces, for regression testing and profiling
+without hardware.
+
+One direction of a trace is played back as if the gimbal sent it, either
+straight into a PacketReceiver or through a pseudo-terminal that a
+GimbalPort (or any other tool) can open. Packets from the other direction
+are what the host is expected to send, and can be checked against what it
+actually writes to the pseudo-terminal.
+
+By default the channel with the most packets is played, in the 'rx'
+direction, unless nearly all of that channel's packets go the other way.
+
+Text traces don't keep timestamps. Original timing is reconstructed from
+the wire time of each played packet at the link's baud rate, so a speed of
+1 is a saturated link and larger speeds compress it further. A speed of
+None plays as fast as possible.
+'''
+
+import os
+import tty
+import sys
+import time
+import argparse
+import threading
+import collections
+
+import fyproto
+import fytrace
+
+
+def select_records(records, channel=None):
+    '''Records from one channel. Defaults to the channel with the most packets.'''
+    records = list(records)
+    if channel is None and records:
+        channel = collections.Counter(r.channel for r in records).most_common(1)[0][0]
+    return [r for r in records if r.channel == channel]
+
+
+def select_feed(records):
+    '''Direction to play back: 'rx', unless it holds under a tenth of the
+       packets, as on a sigrok channel that captured the gimbal's 'tx' line.
+       '''
+    counts = collections.Counter(r.direction for r in records)
+    return 'tx' if counts['rx'] * 10 < counts['tx'] else 'rx'
+
+
+def schedule(records, feed='rx', speed=1.0, baudrate=115200):
+    '''(time offset, record) for each record in the 'feed' direction,
+       in seconds from the start of playback.
+       '''
+    offset = 0.0
+    result = []
+    for record in records:
+        if record.direction != feed:
+            continue
+        result.append((offset, record))
+        if speed:
+            # 8N1 framing, ten bit times per byte
+            offset += record.packet.packed_size() * 10.0 / baudrate / speed
+    return result
+
+
+def _play(timeline, write, start=None, wait=None):
+    '''Write each scheduled record's packet once it's due. Packets due
+       together are packed into one write. 'wait' is called with the
+       record's index before it's played, and may block.
+       '''
+    start = start or time.perf_counter()
+    i = 0
+    while i < len(timeline):
+        delay = start + timeline[i][0] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if wait:
+            wait(i)
+        now = time.perf_counter() - start
+        chunk = bytearray()
+        while i < len(timeline) and timeline[i][0] <= now:
+            chunk += timeline[i][1].packet.pack()
+            i += 1
+            if wait:
+                break
+        write(bytes(chunk))
+
+
+def replay_receiver(records, receiver=None, feed='rx', speed=None, baudrate=115200):
+    '''Play records into a PacketReceiver in this thread.
+       Returns the list of parsed packets.
+       '''
+    receiver = receiver or fyproto.PacketReceiver()
+    packets = []
+    _play(schedule(records, feed, speed, baudrate), lambda data: packets.extend(receiver.parse(data)))
+    return packets
+
+
+class ReplayPort:
+    '''Pseudo-terminal that plays one direction of a trace to whoever opens
+       'port', and checks what they write against the other direction.
+
+       With 'lockstep', each played packet waits until the host has sent
+       every expected packet that came before it in the trace, so replies
+       follow their requests the way they did when the trace was recorded.
+       '''
+    readSize = 4096
+    lockstepTimeout = 5.0
+
+    def __init__(self, records, feed='rx', speed=1.0, baudrate=115200, lockstep=False, verbose=False):
+        self.records = list(records)
+        self.feed = feed
+        self.timeline = schedule(self.records, feed, speed, baudrate)
+        self.lockstep = lockstep
+        self.verbose = verbose
+
+        # Host packets expected before each played packet, for lockstep
+        self.expected = []
+        self.expectedBefore = []
+        for record in self.records:
+            if record.direction == feed:
+                self.expectedBefore.append(len(self.expected))
+            else:
+                self.expected.append(record)
+
+        self.received = []
+        self.mismatches = []
+        self.receivedCV = threading.Condition()
+        self.finished = threading.Event()
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        threading.Thread(target=self._receiveLoop, daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self._playLoop, daemon=True).start()
+
+    def close(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def _wait(self, index):
+        needed = self.expectedBefore[index]
+        with self.receivedCV:
+            self.receivedCV.wait_for(lambda: len(self.received) >= needed, timeout=self.lockstepTimeout)
+
+    def _playLoop(self):
+        try:
+            _play(self.timeline, self._write, wait=self._wait if self.lockstep else None)
+        except OSError:
+            pass
+        self.finished.set()
+
+    def _receiveLoop(self):
+        receiver = fyproto.PacketReceiver()
+        while self.running:
+            try:
+                data = os.read(self.master, self.readSize)
+            except OSError:
+                return
+            for packet in receiver.parse(data):
+                self._check(packet)
+
+    def _check(self, packet):
+        with self.receivedCV:
+            index = len(self.received)
+            self.received.append(packet)
+            if index < len(self.expected):
+                record = self.expected[index]
+                if packet.pack() != record.packet.pack():
+                    self.mismatches.append((record, packet))
+                    if self.verbose:
+                        print("Mismatch at line %d, expected %s and received %s" % (
+                            record.lineno, record.packet, packet))
+            else:
+                self.mismatches.append((None, packet))
+                if self.verbose:
+                    print("Unexpected %s past the end of the trace" % packet)
+            self.receivedCV.notify_all()
+
+    def report(self):
+        '''Summary of the host's packets, compared to the trace'''
+        return {
+            'played': len(self.timeline),
+            'expected': len(self.expected),
+            'received': len(self.received),
+            'mismatches': len(self.mismatches),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a packet trace through a pseudo-terminal')
+    parser.add_argument('--channel', help='sigrok decoder channel, default is the one with the most packets')
+    parser.add_argument('--feed', choices=('rx', 'tx'),
+        help='Direction to play back, default is the one with the most packets')
+    parser.add_argument('--speed', type=float, default=1.0, help='Multiple of the original timing')
+    parser.add_argument('--fast', action='store_true', help='Play as fast as possible')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--receiver', action='store_true',
+        help='Profile PacketReceiver in-process, no pseudo-terminal')
+    parser.add_argument('--gimbal', action='store_true',
+        help='Open a GimbalPort on the replay, and print its stats afterwards')
+    parser.add_argument('--lockstep', action='store_true', help='Wait for expected host packets')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('filename')
+    args = parser.parse_args()
+
+    trace = list(fytrace.read_trace(args.filename))
+    records = select_records(trace, args.channel)
+    if args.feed is None:
+        args.feed = select_feed(records)
+    played = sum(1 for r in records if r.direction == args.feed)
+    if played * 10 < len(trace):
+        channel = records[0].channel if records else args.channel
+        print("Warning: only %d of %d packets in the trace are %s on %r, try --channel and --feed" % (
+            played, len(trace), args.feed, channel), file=sys.stderr)
+    speed = None if args.fast else args.speed
+
+    if args.receiver:
+        start = time.perf_counter()
+        packets = replay_receiver(records, feed=args.feed, speed=speed, baudrate=args.baudrate)
+        elapsed = time.perf_counter() - start
+        print("%d packets in %.3f sec, %.0f packets/sec" % (len(packets), elapsed, len(packets) / elapsed))
+        return
+
+    replay = ReplayPort(records, feed=args.feed, speed=speed, baudrate=args.baudrate,
+        lockstep=args.lockstep, verbose=args.verbose)
+    gimbal = None
+    if args.gimbal:
+        from fyserial import GimbalPort
+        gimbal = GimbalPort(replay.port, verbose=args.verbose, connected=False)
+    else:
+        print("Replaying %s on %s, press enter to start" % (args.filename, replay.port))
+        sys.stdin.readline()
+
+    start = time.perf_counter()
+    replay.start()
+    replay.finished.wait()
+    print("Played in %.3f sec" % (time.perf_counter() - start))
+    if gimbal:
+        # Let the receiver catch up with the last of the data
+        time.sleep(0.1)
+        print(gimbal.stats())
+    print(replay.report())
+
+
+if __name__ == '__main__':
+    main()
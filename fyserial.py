@@ -5,10 +5,14 @@ Serial port interface for talking to Feiyu Tech gimbals.
 import struct
 import threading
 import traceback
+import collections
 import queue
 import time
 
 import fyproto
+import fyparams
+import fymetrics
+import fylog
 import serial
 
 
@@ -17,73 +21,625 @@ class Timeout(Exception):
     pass
 
 
+class CoalescingQueue(queue.Queue):
+    '''Transmit queue where the latest value wins.
+
+       A param set (cmd08) or control packet (cmd01) replaces a pending
+       packet for the same target and param, keeping the older one's place
+       in line. Any other packet is a barrier: nothing queued after it will
+       replace a packet queued before it. That keeps ordering for motor
+       (cmd03), save (cmd05), calibration (cmd0c) and get (cmd06) packets.
+       '''
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+        self.pending = {}
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def coalesceKey(self, packet):
+        if packet.framing != fyproto.SHORT_FORM:
+            return None
+        if packet.command == 0x08 and packet.data:
+            return (packet.target, packet.command, packet.data[0])
+        if packet.command == 0x01:
+            return (packet.target, packet.command)
+
+    def _put(self, packet):
+        key = self.coalesceKey(packet)
+        if key is None:
+            self.pending.clear()
+        elif key in self.pending:
+            self.pending[key][0] = packet
+            return
+        slot = [packet, key]
+        if key is not None:
+            self.pending[key] = slot
+        self.queue.append(slot)
+
+    def _get(self):
+        slot = self.queue.popleft()
+        packet, key = slot
+        if key is not None and self.pending.get(key) is slot:
+            del self.pending[key]
+        return packet
+
+
 class TransmitThread(threading.Thread):
-    def __init__(self, port, verbose=False):
+    # Most packets written to the port in a single call
+    maxBatch = 32
+
+    def __init__(self, port, verbose=False, coalesce=False, metrics=None, recorder=None):
         threading.Thread.__init__(self)
         self.port = port
-        self.queue = queue.Queue()
+        self.queue = CoalescingQueue() if coalesce else queue.Queue()
         self.running = True
         self.verbose = verbose
+        self.metrics = metrics or fymetrics.Metrics()
+        self.recorder = recorder
         self.setDaemon(True)
 
     def run(self):
         while self.running:
             try:
-                p = self.queue.get(timeout=1.0)
+                packets = [self.queue.get(timeout=1.0)]
             except queue.Empty:
-                pass
-            else:
-                if self.verbose:
+                continue
+            # Anything else already waiting goes out in the same write
+            while len(packets) < self.maxBatch:
+                try:
+                    packets.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.verbose:
+                for p in packets:
                     print("TX %s" % p)
-                self.port.write(p.pack())
+            self.write(packets)
+
+    def write(self, packets):
+        frames = []
+        for p in packets:
+            frame = p.pack()
+            frames.append(frame)
+            self.metrics.count('tx.packets.cmd%02x' % p.command)
+            self.metrics.count('tx.bytes.cmd%02x' % p.command, len(frame))
+        data = b''.join(frames)
+        self.port.write(data)
+        self.metrics.count('tx.writes')
+        if self.recorder:
+            self.recorder.record(fylog.TX, data)
 
 
 class ReceiverThread(threading.Thread):
     receiverClass = fyproto.PacketReceiver
 
-    def __init__(self, port, callback, verbose=False):
+    def __init__(self, port, callback, verbose=False, metrics=None, recorder=None):
         threading.Thread.__init__(self)
         self.port = port
         self.callback = callback
         self.running = True
         self.verbose = verbose
+        self.metrics = metrics or fymetrics.Metrics()
+        self.recorder = recorder
         self.receiver = self.receiverClass()
         self.setDaemon(True)
 
     def run(self):
         while self.running:
-            for packet in self.receiver.parse(self.port.read(1)):
+            # Block for at least one byte, then take everything already
+            # buffered, so bursts are parsed in one call without adding
+            # latency when traffic is light.
+            data = self.port.read(max(1, self.port.in_waiting))
+            self.metrics.count('rx.bytes', len(data))
+            if self.recorder:
+                self.recorder.record(fylog.RX, data)
+            for packet in self.receiver.parse(data):
                 if self.verbose:
                     print("RX %s" % packet)
+                self.metrics.count('rx.packets.cmd%02x' % packet.command)
+                self.metrics.count('rx.bytes.cmd%02x' % packet.command, packet.packed_size())
                 try:
                     self.callback(packet)
                 except:
                     traceback.print_exc()
 
 
+class RoundTripEstimator:
+    '''Smoothed round-trip time and variance for one MCU, as in TCP (RFC 6298).
+       Gives a retransmission timeout that tracks the measured link latency,
+       and backs off exponentially while responses keep getting lost.
+
+       The timeout never drops below 'minTimeout', which callers should set
+       to at least the time a full pipelined group takes on the wire.
+       '''
+    alpha = 1/8.
+    beta = 1/4.
+    k = 4
+    minTimeout = 0.005
+
+    def __init__(self, initialTimeout, maxTimeout, minTimeout=None):
+        self.maxTimeout = maxTimeout
+        if minTimeout is not None:
+            self.minTimeout = minTimeout
+        self.srtt = None
+        self.rttvar = None
+        self.maxRtt = 0.0
+        self.rto = initialTimeout
+
+    def sample(self, rtt):
+        self.maxRtt = max(self.maxRtt, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = min(self.maxTimeout, max(self.minTimeout, self.srtt + self.k * self.rttvar))
+
+    def backoff(self):
+        self.rto = min(self.maxTimeout, self.rto * 2)
+
+    def timeout(self):
+        return self.rto
+
+
+class ParamCache:
+    '''Param values recently read from or written to the gimbal.
+
+       Each param number gets a time-to-live from its staleness class in
+       params.txt. A TTL of 0 means never cache, None means keep the value
+       until the cache is invalidated. Values are stored as the raw 2-byte
+       payload, so they can be unpacked with any format.
+
+       Writes and invalidations bump a generation counter. A value read
+       from the gimbal is only stored if nothing wrote or invalidated that
+       param since the read started, so a read that was in flight during
+       a setParam() can't put the old value back.
+       '''
+    ttls = {
+        'dynamic': 0,
+        'rw': 0,
+        'init': None,
+        'static': None,
+    }
+    unknownStaleness = 'dynamic'
+
+    def __init__(self, schema=None, ttls=None):
+        self.schema = schema if schema is not None else fyparams.load_schema()
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.written = {}
+        self.targetsInvalidated = {}
+        self.allInvalidated = 0
+
+    def ttl(self, number):
+        info = self.schema.get(number)
+        return self.ttls[info.staleness if info else self.unknownStaleness]
+
+    def get(self, target, number):
+        '''Cached raw value, or None on a miss'''
+        with self.lock:
+            entry = self.values.get((target, number))
+            if entry is not None:
+                data, expires = entry
+                if expires is None or time.time() < expires:
+                    self.hits += 1
+                    return data
+                del self.values[(target, number)]
+            self.misses += 1
+
+    def current(self):
+        '''Generation to pass to put() for a read starting now'''
+        with self.lock:
+            return self.generation
+
+    def put(self, target, number, data, since=None):
+        '''Store a value. Written values have no 'since'. Values read from
+           the gimbal give the generation from when their read started,
+           and are dropped if the param was written or invalidated after it.
+           '''
+        key = (target, number)
+        with self.lock:
+            if since is None:
+                self.generation += 1
+                self.written[key] = self.generation
+            elif max(self.written.get(key, 0), self.targetsInvalidated.get(target, 0),
+                     self.allInvalidated) > since:
+                return
+            ttl = self.ttl(number)
+            if ttl == 0:
+                return
+            self.values[key] = (data, ttl and (time.time() + ttl))
+
+    def invalidate(self, targets=None):
+        '''Forget cached values, for all targets or only the listed ones'''
+        with self.lock:
+            self.generation += 1
+            if targets is None:
+                self.values.clear()
+                self.allInvalidated = self.generation
+            else:
+                targets = set(targets)
+                for t in targets:
+                    self.targetsInvalidated[t] = self.generation
+                for key in [k for k in self.values if k[0] in targets]:
+                    del self.values[key]
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'entries': len(self.values) }
+
+
+class SharedRead:
+    '''One read of a param, whose result goes to everyone who asked for it'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+        self.finished = None
+
+    def wait(self, timeout=None):
+        '''Raw value, or the leader's exception'''
+        if not self.done.wait(timeout):
+            raise Timeout()
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+
+class SharedReads:
+    '''Single-flight param reads.
+
+       The first caller to read a param leads, doing the transaction
+       itself, and identical reads that arrive while it's in flight wait
+       for its result instead of sending their own. With a coalescing
+       'window' in seconds, a finished read also answers reads that start
+       up to that long after it.
+       '''
+    def __init__(self, window=0.0):
+        self.window = window
+        self.reads = {}
+        self.lock = threading.Lock()
+
+    def claim(self, target, number, join=True):
+        '''(SharedRead, leader) for a param. A leader must finish() the read.
+           Without 'join', always lead a new read, which later callers can join.
+           '''
+        key = (target, number)
+        with self.lock:
+            read = self.reads.get(key)
+            if join and read is not None:
+                if not read.done.is_set() or time.time() - read.finished <= self.window:
+                    return read, False
+            read = self.reads[key] = SharedRead()
+            return read, True
+
+    def finish(self, target, number, read, data=None, error=None):
+        key = (target, number)
+        with self.lock:
+            read.data, read.error, read.finished = data, error, time.time()
+            if (error is not None or not self.window) and self.reads.get(key) is read:
+                del self.reads[key]
+        read.done.set()
+
+    def invalidate(self, targets=None, number=None):
+        '''Stop sharing reads already in flight or finished, for all targets or
+           only the listed ones, and all params or only one. Their leaders still finish them.
+           '''
+        with self.lock:
+            for key in [k for k in self.reads if (targets is None or k[0] in targets) and
+                                                 (number is None or k[1] == number)]:
+                del self.reads[key]
+
+
+TelemetrySample = collections.namedtuple('TelemetrySample', 'target number value time')
+
+
+class TelemetryChannel:
+    '''Polling state for one (target, number) param, shared by all of its subscriptions.
+       Stream channels are never polled, and have no deadline.
+       '''
+    # Samples older than this don't count towards the achieved rate
+    rateWindow = 5.0
+
+    def __init__(self, target, number, deadline=None):
+        self.target = target
+        self.number = number
+        self.subscriptions = []
+        self.release = time.time()
+        self.deadline = deadline
+        self.failures = 0
+        self.latest = None
+        self.times = collections.deque(maxlen=32)
+
+    @property
+    def rate(self):
+        return max(s.rate for s in self.subscriptions)
+
+    def update(self, value, now):
+        '''Record a new value and hand it to every subscription'''
+        self.latest = sample = TelemetrySample(self.target, self.number, value, now)
+        self.times.append(now)
+        for s in list(self.subscriptions):
+            s.received.set()
+            if s.callback:
+                try:
+                    s.callback(sample)
+                except:
+                    traceback.print_exc()
+
+    def achievedRate(self, now=None):
+        '''Samples per second, over the most recent samples up to now.
+           Falls as soon as samples stop arriving, and reaches 0 after rateWindow.
+           '''
+        now = time.time() if now is None else now
+        recent = [t for t in self.times if t > now - self.rateWindow]
+        if len(recent) < 2 or now <= recent[0]:
+            return 0.0
+        return (len(recent) - 1) / (now - recent[0])
+
+
+class TelemetrySubscription:
+    def __init__(self, channel, rate, callback=None):
+        self.channel = channel
+        self.rate = rate
+        self.callback = callback
+        self.received = threading.Event()
+
+    def latest(self):
+        '''Most recent TelemetrySample, or None before the first one'''
+        return self.channel.latest
+
+    def wait(self, timeout=None):
+        '''Most recent TelemetrySample, waiting for the first if necessary'''
+        if not self.received.wait(timeout):
+            raise Timeout()
+        return self.channel.latest
+
+
+class TelemetryScheduler(threading.Thread):
+    '''Polls subscribed params in the background, each at its requested rate.
+
+       A param is released for reading once per period. Each round reads
+       the released params earliest deadline first, up to 'window' of them,
+       with one pipelined getParams() call. Reads are also rate limited to
+       'linkShare' of the UART's capacity, leaving the rest for other
+       traffic.
+
+       Deadlines advance by one period per read, from the deadline of the
+       last read served rather than from the clock. When subscriptions ask
+       for more than the link can carry, every param then slows down in
+       proportion to its requested rate, and rates() shows by how much.
+
+       A round that times out is read again one param at a time, to find
+       the param that doesn't answer. That param is then read on its own,
+       outside the pipelined round, and released less often after each
+       failure, up to 'maxBackoff' seconds apart, until it answers again.
+       Each read gets no longer than its params' shortest period.
+
+       Subscribing with an fyproto.Message in place of a param number
+       follows an unsolicited stream instead, like the gimbal's cmd0d
+       packets. Stream packets are captured as they arrive, whether or not
+       anyone has subscribed, and cost no requests. Their samples carry the
+       Message as their number, its decoded named tuple as their value,
+       and their callbacks run on the receiver thread. The requested rate
+       is ignored, streams arrive at whatever rate the gimbal sends them.
+       '''
+    linkShare = 0.5
+    window = 16
+    retries = 1
+    maxBackoff = 5.0
+
+    def __init__(self, gimbal):
+        threading.Thread.__init__(self)
+        self.gimbal = gimbal
+        self.channels = {}
+        self.streams = {}
+        self.cv = threading.Condition()
+        self.running = True
+
+        # The larger of request and response limits reads per second, in 8N1 bytes
+        request = fyproto.Packet(target=0, command=0x06, data=b'\x00').packed_size()
+        response = fyproto.Packet(target=3, command=0x06, data=b'\x00\x00').packed_size()
+        self.maxReadRate = self.linkShare * gimbal.port.baudrate / 10.0 / max(request, response)
+        self.tokens = self.window
+        self.refilled = time.time()
+        self.virtualTime = time.time()
+        self.setDaemon(True)
+
+    def subscribe(self, target, number, rate, callback=None):
+        '''Poll a param at 'rate' Hz. The callback, if any, gets every TelemetrySample
+           from the scheduler's thread. Returns a TelemetrySubscription.
+           '''
+        with self.cv:
+            if isinstance(number, fyproto.Message):
+                channel = self._stream(target, number)
+                subscription = TelemetrySubscription(channel, rate, callback)
+                if channel.latest:
+                    subscription.received.set()
+                channel.subscriptions.append(subscription)
+                return subscription
+            channel = self.channels.get((target, number))
+            if channel is None:
+                channel = self.channels[(target, number)] = TelemetryChannel(
+                    target, number, self.virtualTime + 1.0 / rate)
+            subscription = TelemetrySubscription(channel, rate, callback)
+            channel.subscriptions.append(subscription)
+            self.cv.notify()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.cv:
+            channel = subscription.channel
+            channel.subscriptions.remove(subscription)
+            if not channel.subscriptions and channel.deadline is not None:
+                del self.channels[(channel.target, channel.number)]
+
+    def latest(self, target, number):
+        '''Most recent TelemetrySample for a subscribed param or a stream, or None'''
+        channel = (self.streams if isinstance(number, fyproto.Message) else self.channels).get((target, number))
+        return channel and channel.latest
+
+    def _stream(self, target, message):
+        channel = self.streams.get((target, message))
+        if channel is None:
+            channel = self.streams[(target, message)] = TelemetryChannel(target, message)
+        return channel
+
+    def receiveStream(self, packet, message):
+        '''Capture an unsolicited stream packet, called from the receiver thread'''
+        now = time.time()
+        with self.cv:
+            channel = self._stream(packet.target, message)
+        channel.update(message.decode(packet), now)
+
+    def rates(self):
+        '''Requested and achieved rates for each polled param'''
+        with self.cv:
+            return [{
+                'target': c.target,
+                'number': c.number,
+                'requested': c.rate,
+                'achieved': c.achievedRate(),
+            } for c in self.channels.values()] + [{
+                'target': c.target,
+                'number': c.number.name,
+                'requested': None,
+                'achieved': c.achievedRate(),
+            } for c in self.streams.values()]
+
+    def stop(self):
+        with self.cv:
+            self.running = False
+            self.cv.notify()
+
+    def _nextBatch(self):
+        '''Released channels to read now, waiting until there are some'''
+        with self.cv:
+            while self.running:
+                now = time.time()
+                self.tokens = min(self.window, self.tokens + (now - self.refilled) * self.maxReadRate)
+                self.refilled = now
+                released = [c for c in self.channels.values() if c.release <= now]
+                if not released:
+                    wake = min((c.release for c in self.channels.values()), default=None)
+                    self.cv.wait(None if wake is None else wake - now)
+                elif self.tokens < 1:
+                    self.cv.wait((1 - self.tokens) / self.maxReadRate)
+                else:
+                    released.sort(key=lambda c: c.deadline)
+                    batch = released[:int(self.tokens)]
+                    self.tokens -= len(batch)
+                    for c in batch:
+                        # Catch up on small delays, but don't burst after long ones
+                        period = 1.0 / c.rate
+                        c.release = max(c.release + period, now - period)
+                        self.virtualTime = max(self.virtualTime, c.deadline)
+                        c.deadline = max(c.deadline, self.virtualTime) + period
+                    return batch
+        return []
+
+    def _readDeadline(self, channels):
+        '''Time allowed for a round, retries included. A read is no use
+           once the next one is due, but it needs at least a couple of
+           group times on the wire.
+           '''
+        with self.cv:
+            period = min((1.0 / c.rate for c in channels if c.subscriptions), default=self.gimbal.operationTimeout)
+        return min(self.gimbal.operationTimeout, max(2 * self.gimbal.groupWireTime(), period))
+
+    def _backoff(self, channel):
+        '''Release a param that didn't answer later, the more so the more often it fails'''
+        with self.cv:
+            channel.failures += 1
+            if channel.subscriptions:
+                delay = min(self.maxBackoff, 2 ** channel.failures / channel.rate)
+                channel.release = max(channel.release, time.time() + delay)
+
+    def run(self):
+        while self.running:
+            batch = self._nextBatch()
+            # Params that failed recently are read on their own, so they can't fail the rest
+            groups = [[c for c in batch if not c.failures]]
+            groups += [[c] for c in batch if c.failures]
+            while groups and self.running:
+                group = groups.pop(0)
+                if not group:
+                    continue
+                try:
+                    values = self.gimbal.getParams([(c.target, c.number) for c in group],
+                        window=self.window, retries=self.retries, cached=False,
+                        deadline=self._readDeadline(group))
+                except Timeout:
+                    self.gimbal.metrics.count('telemetry.timeouts')
+                    if len(group) > 1:
+                        groups[:0] = [[c] for c in group]
+                    else:
+                        self._backoff(group[0])
+                    continue
+                except Exception:
+                    # The port may be closing underneath a read in progress
+                    if self.running:
+                        raise
+                    return
+                now = time.time()
+                for c, value in zip(group, values):
+                    c.failures = 0
+                    c.update(value, now)
+
+
 class GimbalPort:
     '''High-level connection to a Feiyu Tech gimbal,
        with background threads handling serial communication.
        '''
     transmitThreadClass = TransmitThread
     receiverThreadClass = ReceiverThread
+    paramCacheClass = ParamCache
+    sharedReadsClass = SharedReads
+    telemetrySchedulerClass = TelemetryScheduler
+
+    # Unsolicited packets captured as passive telemetry, see TelemetryScheduler
+    streamMessages = (fyproto.STREAM, fyproto.CONTROL)
 
     axes = range(3)
     transactionRetries = 15
     transactionTimeout = 2.0
+    operationTimeout = 5.0
+    probeTimeout = 0.1
+    drainTimeout = 0.05
+    pipelineWindow = 16
     connectTimeout = 10.0
 
-    def __init__(self, port='/dev/ttyAMA0', baudrate=115200, verbose=True, connected=None):
+    def __init__(self, port='/dev/ttyAMA0', baudrate=115200, verbose=True, connected=None, cache=False,
+                 coalesce=False, record=None, readWindow=0.0):
         self.verbose = verbose
         self.version = None
+        self.cache = self.paramCacheClass() if cache else None
+        self.reads = self.sharedReadsClass(readWindow)
+        self.metrics = fymetrics.Metrics()
+        self.recorder = fylog.PacketRecorder(record) if record else None
 
         self.connectedCV = threading.Condition()
         self.responseQueue = queue.Queue()
         self.port = serial.Serial(port, baudrate=baudrate)
         self._transactionLock = threading.Lock()
-
-        self.tx = self.transmitThreadClass(self.port, verbose=self.verbose)
-        self.rx = self.receiverThreadClass(self.port, callback=self._receive, verbose=self.verbose)
+        self.roundTrips = {}
+        self._telemetry = None
+        self._telemetryLock = threading.Lock()
+
+        self.tx = self.transmitThreadClass(self.port, verbose=self.verbose, coalesce=coalesce,
+            metrics=self.metrics, recorder=self.recorder)
+        self.rx = self.receiverThreadClass(self.port, callback=self._receive, verbose=self.verbose,
+            metrics=self.metrics, recorder=self.recorder)
+        self.metrics.gauge('tx.queue_depth', self.tx.queue.qsize)
+        self.metrics.gauge('rx.crc_errors', lambda: self.rx.receiver.crcErrors)
+        self.metrics.gauge('rx.resync_bytes', lambda: self.rx.receiver.resyncBytes)
+        if self.cache is not None:
+            self.metrics.gauge('cache', self.cache.stats)
         self.rx.start()
         self.tx.start()
 
@@ -98,18 +654,39 @@ class GimbalPort:
             else:
                 print("Waiting for gimbal to power on")
 
+    def stats(self):
+        '''Snapshot of link metrics: counters, latency percentiles and gauges'''
+        return self.metrics.snapshot()
+
+    @property
+    def telemetry(self):
+        '''TelemetryScheduler for this port, started on first use'''
+        # The receiver thread can get here first, with a stream packet
+        with self._telemetryLock:
+            if self._telemetry is None:
+                self._telemetry = self.telemetrySchedulerClass(self)
+                self._telemetry.start()
+        return self._telemetry
+
     def close(self):
+        # The scheduler reads through the port, let any read in progress
+        # finish before the threads and port go away underneath it
+        if self._telemetry:
+            self._telemetry.stop()
+            self._telemetry.join()
         self.rx.running = False
         self.tx.running = False
         self.rx.join()
         self.tx.join()
         self.port.close()
+        if self.recorder:
+            self.recorder.close()
 
     def _testForExistingConnection(self):
         if self.verbose:
             print("Checking for existing connection")
         try:
-            paramVersion = self.getParam(target=0, number=0x7f, retries=0, timeout=0.1)
+            paramVersion = self.getParam(target=0, number=0x7f, retries=0, timeout=self.probeTimeout)
             self.version = self.version or (paramVersion / 100)
             return True
         except Timeout:
@@ -117,7 +694,7 @@ class GimbalPort:
 
     def flush(self, timeout=None):
         # Perform an unnecessary 'get' to ensure all other commands have been seen
-        self.getParam(target=0, number=0x7f, retries=0, timeout=timeout)
+        self.getParam(target=0, number=0x7f, retries=0, timeout=timeout, cached=False)
 
     def send(self, packet):
         self.waitConnect()
@@ -140,20 +717,28 @@ class GimbalPort:
         if packet.framing == fyproto.LONG_FORM:
             if packet.command == 0x00:
                 self.cmd00 = packet
-                _unknown, version = struct.unpack("<HH", packet.data)
-                self.version = version / 100.0
+                self.version = fyproto.VERSION.decode(packet).version / 100.0
+                if self.cache:
+                    self.cache.invalidate()
                 return
 
         if packet.framing == fyproto.SHORT_FORM:
             if packet.command == 0x0B:
                 if self.verbose:
                     print("Connecting to gimbal, firmware version %s" % self.version)
+                if self.cache:
+                    self.cache.invalidate()
                 with self.connectedCV:
                     self.connected = True
                     self.send(fyproto.Packet(target=0, command=0x0b, data=bytes([0x01])))
                     self.connectedCV.notify_all()
                 return
 
+            message = fyproto.find_message(packet)
+            if message in self.streamMessages:
+                self.telemetry.receiveStream(packet, message)
+                return
+
             if packet.target == 0x03:
                 self.responseQueue.put(packet)
                 return
@@ -167,27 +752,144 @@ class GimbalPort:
                 packet = self.responseQueue.get(timeout=timeout)
                 if packet.command == command:
                     return packet
+                self.metrics.count('rx.ignored_responses')
                 if self.verbose:
                     print("Ignored response %r" % packet)
         except queue.Empty:
             raise Timeout()
 
-    def transaction(self, packet, timeout=None, retries=None):
+    def _drainResponses(self, timeout):
+        '''Discard responses until none arrive for 'timeout' seconds.
+           After a timeout we can't tell which request lost its response,
+           and a late one must not be mistaken for the answer to a retry.
+           '''
+        try:
+            while True:
+                packet = self.responseQueue.get(timeout=timeout)
+                self.metrics.count('rx.discarded_responses')
+                if self.verbose:
+                    print("Discarded late response %r" % packet)
+        except queue.Empty:
+            pass
+
+    def roundTrip(self, target):
+        '''RoundTripEstimator for one target MCU'''
+        if target not in self.roundTrips:
+            self.roundTrips[target] = RoundTripEstimator(self.transactionTimeout, self.transactionTimeout,
+                max(RoundTripEstimator.minTimeout, self.groupWireTime()))
+        return self.roundTrips[target]
+
+    def groupWireTime(self):
+        '''Seconds to send a full pipelined group of reads and receive their
+           responses, in 8N1 bytes at the port's baud rate. No timeout can
+           usefully be shorter.
+           '''
+        request = fyproto.Packet(target=0, command=0x06, data=b'\x00').packed_size()
+        response = fyproto.Packet(target=3, command=0x06, data=b'\x00\x00').packed_size()
+        return self.pipelineWindow * (request + response) * 10.0 / self.port.baudrate
+
+    def lateResponseTimeout(self, estimators):
+        '''How long to keep draining late responses after a timeout. The
+           adaptive timeout can sit far below the latency of a slow reply,
+           so this is never less than drainTimeout, or a few of the largest
+           round trips seen.
+           '''
+        return max(self.drainTimeout, max(RoundTripEstimator.k * e.maxRtt for e in estimators))
+
+    def transaction(self, packet, timeout=None, retries=None, deadline=None):
         '''Send a packet, and wait for the corresponding response, with retry on timeout'''
+        return self.transactions([packet], window=1, timeout=timeout, retries=retries, deadline=deadline)[0]
+
+    def transactions(self, packets, window=None, timeout=None, retries=None, deadline=None):
+        '''Send many packets, keeping up to 'window' of them in flight,
+           and return their responses in the same order.
+
+           Responses don't identify the request they answer (a cmd06 reply
+           doesn't echo the param number) so they are matched in order of
+           issue. Requests go out in groups of 'window', and a group only
+           completes once every request in it has been answered. If any
+           response times out, late responses are drained and the whole
+           group is retried, so a lost response doesn't shift the remaining
+           answers onto the wrong requests. Draining lasts at least
+           drainTimeout, and a few of the largest round trips seen; a reply
+           delayed by even longer than that can't be told apart from the
+           answer to the next request.
+
+           Unless a fixed per-attempt 'timeout' is given, each attempt waits
+           for the adaptive timeout of the slowest target in its group. That
+           timeout only doubles when an attempt gets no answers at all, since
+           a group with some answers lost a packet rather than waited too
+           little. After a loss the window halves, so each retry risks fewer
+           requests, and it grows back by one for every group that completes.
+
+           Each group gets its own 'retries', and by default its own
+           operationTimeout, so a long sweep isn't held to the time limit of
+           a single operation. A 'deadline' in seconds bounds the whole call
+           instead, retries included.
+           '''
         self.waitConnect()
-        if timeout is None:
-            timeout = self.transactionTimeout
+        if window is None:
+            window = self.pipelineWindow
         if retries is None:
             retries = self.transactionRetries
-        while True:
+        finish = None if deadline is None else time.time() + deadline
+        packets = list(packets)
+        responses = []
+        currentWindow = window
+        retried = False
+        while len(responses) < len(packets):
+            group = packets[len(responses):len(responses) + currentWindow]
+            if not retried:
+                groupRetries = retries
+                if deadline is None:
+                    finish = time.time() + self.operationTimeout
+            estimators = set(self.roundTrip(p.target) for p in group)
+            attemptTimeout = timeout
+            if attemptTimeout is None:
+                # Later responses in a group queue up behind earlier ones,
+                # allow at worst one more round trip for each
+                attemptTimeout = (max(e.timeout() for e in estimators) +
+                    (len(group) - 1) * max(e.srtt or 0 for e in estimators))
+            attemptTimeout = min(attemptTimeout, max(0, finish - time.time()))
             try:
                 with self._transactionLock:
-                    self.send(packet)
-                    return self._waitResponse(packet.command, timeout=timeout)
+                    groupResponses = []
+                    try:
+                        # Anything still queued is a late answer to an earlier request
+                        self._drainResponses(0)
+                        sent = time.time()
+                        for packet in group:
+                            self.send(packet)
+                        arrivals = []
+                        for packet in group:
+                            groupResponses.append(self._waitResponse(
+                                packet.command, timeout=max(0, sent + attemptTimeout - time.time())))
+                            arrivals.append(time.time())
+                    except Timeout:
+                        self.metrics.count('transaction.timeouts')
+                        if not groupResponses:
+                            for e in estimators:
+                                e.backoff()
+                        self._drainResponses(self.lateResponseTimeout(estimators))
+                        raise
+                # Only the first response measures a plain round trip, and only
+                # when it can't be a late answer to an earlier attempt
+                if not retried:
+                    self.roundTrip(group[0].target).sample(arrivals[0] - sent)
+                for packet, arrival in zip(group, arrivals):
+                    self.metrics.observe('transaction.latency.t%02x.cmd%02x' % (packet.target, packet.command),
+                        arrival - sent)
+                responses.extend(groupResponses)
+                retried = False
+                currentWindow = min(window, currentWindow + 1)
             except Timeout:
-                retries -= 1
-                if retries < 0:
+                retried = True
+                groupRetries -= 1
+                if groupRetries < 0 or time.time() >= finish:
                     raise
+                currentWindow = max(1, currentWindow // 2)
+                self.metrics.count('transaction.retries')
+        return responses
 
     def setMotors(self, enable, targets=axes):
         # Not sure if order matters
@@ -202,6 +904,9 @@ class GimbalPort:
         for target in targets:
             p = fyproto.Packet(target=target, command=0x0c, data=struct.pack('B', num))
             self.transaction(p)
+        self.reads.invalidate(targets)
+        if self.cache:
+            self.cache.invalidate(targets)
 
     def saveParams(self, targets=axes, timeout=None, retries=None):
         for target in targets:
@@ -211,17 +916,69 @@ class GimbalPort:
                 raise IOError("Failed to save parameters, response %r" % packet)
             if self.verbose:
                 print("Saved params on MCU %d" % target)
+        self.reads.invalidate(targets)
+        if self.cache:
+            self.cache.invalidate(targets)
 
-    def getParam(self, target, number, fmt='h', timeout=None, retries=None):
-        p = fyproto.Packet(target=target, command=0x06, data=struct.pack('B', number))
-        r = self.transaction(p, timeout=timeout, retries=retries)
-        return struct.unpack('<' + fmt, r.data)[0]
+    def getParam(self, target, number, fmt='h', timeout=None, retries=None, cached=True, deadline=None):
+        return self.getParams([(target, number)], fmt=fmt, window=1,
+            timeout=timeout, retries=retries, cached=cached, deadline=deadline)[0]
 
-    def setParam(self, target, number, value, fmt='h'):
-        self.send(fyproto.Packet(target=target, command=0x08, data=struct.pack('<BB' + fmt, number, 0, value)))
+    def getParams(self, params, fmt='h', window=None, timeout=None, retries=None, cached=True, deadline=None):
+        '''Read a list of (target, number) params, pipelined. Returns a list of values.
+           With a param cache, fresh cached values are used and only the rest are read.
 
-    def getVectorParam(self, number, targets=axes, timeout=None, retries=None):
-        return tuple(self.getParam(t, number, timeout=timeout, retries=retries) for t in targets)
+           Reads are single-flight: a param that another thread is already
+           reading is not requested again, its result is shared. With
+           cached=False the read is always sent, though others can still share it.
+           '''
+        params = list(params)
+        raw = [None] * len(params)
+        if self.cache and cached:
+            raw = [self.cache.get(t, n) for t, n in params]
+        missing = [i for i, data in enumerate(raw) if data is None]
+        if missing:
+            finish = time.time() + (self.operationTimeout if deadline is None else deadline)
+            generation = self.cache and self.cache.current()
+            claims = {i: self.reads.claim(params[i][0], params[i][1], join=cached) for i in missing}
+            leading = [i for i in missing if claims[i][1]]
+            self.metrics.count('read.shared', len(missing) - len(leading))
+            packets = [fyproto.Packet(target=params[i][0], command=0x06, data=struct.pack('B', params[i][1]))
+                       for i in leading]
+            try:
+                responses = self.transactions(packets, window=window, timeout=timeout, retries=retries,
+                    deadline=deadline) if packets else []
+            except Exception as e:
+                for i in leading:
+                    self.reads.finish(params[i][0], params[i][1], claims[i][0], error=e)
+                raise
+            for i, r in zip(leading, responses):
+                self.reads.finish(params[i][0], params[i][1], claims[i][0], data=r.data)
+                if self.cache:
+                    self.cache.put(params[i][0], params[i][1], r.data, since=generation)
+            for i in missing:
+                raw[i] = claims[i][0].wait(max(0, finish - time.time()))
+        return [struct.unpack('<' + fmt, data)[0] for data in raw]
+
+    def setParam(self, target, number, value, fmt='h'):
+        data = struct.pack('<' + fmt, value)
+        self.send(fyproto.Packet(target=target, command=0x08, data=struct.pack('<BB', number, 0) + data))
+        # Reads already in flight may not see the new value
+        self.reads.invalidate([target], number)
+        if self.cache:
+            self.cache.put(target, number, data)
+
+    def getVectorParam(self, number, targets=axes, timeout=None, retries=None, deadline=None):
+        return tuple(self.getParams([(t, number) for t in targets], timeout=timeout, retries=retries,
+            deadline=deadline))
+
+    def getVectorParams(self, numbers, targets=axes, window=None, timeout=None, retries=None, deadline=None):
+        '''Read several vector params in one pipelined sweep. Returns a list of tuples.'''
+        numbers = list(numbers)
+        values = self.getParams([(t, n) for n in numbers for t in targets],
+            window=window, timeout=timeout, retries=retries, deadline=deadline)
+        width = len(targets)
+        return [tuple(values[i*width:(i+1)*width]) for i in range(len(numbers))]
 
     def setVectorParam(self, number, value, targets=axes):
         for i, t in enumerate(targets):
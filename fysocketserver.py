@@ -3,60 +3,562 @@
 # Websocket server providing access to gimbal parameters.
 # Runs standalone or as a library embedded in other utils.
 #
+# The gimbal can be a threaded fyserial.GimbalPort, whose blocking calls
+# run in the default executor, or an fyasync.AsyncGimbalPort driven
+# directly by the server's own event loop.
+#
+# Besides one-off get/set commands, clients can subscribe to params. Each
+# subscribed param is sampled once on the server at the fastest rate any
+# client asked for, and samples are pushed to each client at its own rate.
+#
+# Clients speak the default text protocol, one space-separated command or
+# reply per line, or negotiate the 'fygimbal-binary' subprotocol, whose
+# frames are runs of fixed-size records. See BinaryProtocol.
+#
+# Every value the server reads is also kept in a fixed-size history ring
+# per param, so a new client can fetch the last few minutes of a param,
+# downsampled, without any extra serial traffic.
+#
 
-from fyserial import GimbalPort
+from fyasync import AsyncGimbalPort
 import threading
 import functools
+import collections
 import asyncio
+import json
+import time
+import struct
+import array
+import bisect
 import websockets
 
 
+Command = collections.namedtuple('Command', 'op target number value')
+
+# Replies, and pushed samples
+Value = collections.namedtuple('Value', 'target number value time')
+Error = collections.namedtuple('Error', 'index message')
+Stats = collections.namedtuple('Stats', 'data')
+History = collections.namedtuple('History', 'target number samples')
+
+
+class TextProtocol:
+    '''One command or reply per line, space-separated'''
+    name = None
+
+    def decode(self, message):
+        '''(index, Command or exception) for each line of a message'''
+        if not isinstance(message, str):
+            raise ValueError("Expected text frames")
+        commands = []
+        for index, line in enumerate(message.split('\n')):
+            tokens = line.split()
+            if tokens:
+                try:
+                    commands.append((index, self.parse(tokens)))
+                except Exception as e:
+                    commands.append((index, e))
+        return commands
+
+    def parse(self, tokens):
+        op = tokens[0]
+        if op in ('get', 'unsubscribe'):
+            return Command(op, int(tokens[1]), int(tokens[2]), None)
+        if op == 'set':
+            return Command(op, int(tokens[1]), int(tokens[2]), int(tokens[3]))
+        if op == 'subscribe':
+            return Command(op, int(tokens[1]), int(tokens[2]), float(tokens[3]))
+        if op == 'motors':
+            return Command(op, None, None, int(tokens[1]))
+        if op == 'stats':
+            return Command(op, None, None, None)
+        if op == 'history':
+            return Command(op, int(tokens[1]), int(tokens[2]), (float(tokens[3]), int(tokens[4])))
+        raise ValueError("Unrecognized command %r" % op)
+
+    def encode(self, replies):
+        lines = []
+        for r in replies:
+            if isinstance(r, Value):
+                lines.append('value %d %d %d' % (r.target, r.number, r.value))
+            elif isinstance(r, Error):
+                lines.append('error %d %s' % (r.index, r.message))
+            elif isinstance(r, History):
+                # Time and value pairs, after the param
+                lines.append(' '.join(['history %d %d' % (r.target, r.number)] +
+                    ['%.3f %d' % sample for sample in r.samples]))
+            else:
+                # Link metrics, as JSON after the 'stats' keyword
+                lines.append('stats ' + json.dumps(r.data, sort_keys=True))
+        return '\n'.join(lines)
+
+
+class BinaryProtocol:
+    '''Binary frames, each a run of 16-byte little-endian records:
+
+           op        uint8
+           target    uint8
+           number    uint8
+           (pad)     uint8
+           value     int32
+           real      float64
+
+       Ops, with the fields they use:
+
+           1  get          client  target, number
+           2  set          client  target, number, value
+           3  value        server  target, number, value, real = sample time in seconds since the epoch
+           4  subscribe    client  target, number, real = rate in Hz
+           5  unsubscribe  client  target, number
+           6  motors       client  value
+           7  error        server  value = index of the failing record
+           8  history      client  target, number, value = max points, real = since
+
+       History is answered with value records, oldest first.
+       Stats are only available in the text protocol. A frame that isn't
+       a whole number of records gets an error for its trailing bytes.
+       '''
+    name = 'fygimbal-binary'
+    record = struct.Struct('<BBBxid')
+    ops = (None, 'get', 'set', 'value', 'subscribe', 'unsubscribe', 'motors', 'error', 'history')
+    commands = ('get', 'set', 'subscribe', 'unsubscribe', 'motors', 'history')
+
+    def decode(self, message):
+        if isinstance(message, str):
+            raise ValueError("Expected binary frames")
+        whole = len(message) - len(message) % self.record.size
+        commands = []
+        for index, (op, target, number, value, real) in enumerate(self.record.iter_unpack(message[:whole])):
+            op = self.ops[op] if op < len(self.ops) else op
+            if op not in self.commands:
+                commands.append((index, ValueError("Unrecognized op %r" % op)))
+            elif op == 'subscribe':
+                commands.append((index, Command(op, target, number, real)))
+            elif op == 'history':
+                commands.append((index, Command(op, target, number, (real, value))))
+            else:
+                commands.append((index, Command(op, target, number, value)))
+        if whole < len(message):
+            commands.append((whole // self.record.size,
+                ValueError("Partial record, %d bytes" % (len(message) - whole))))
+        return commands
+
+    def encode(self, replies):
+        out = bytearray()
+        for r in replies:
+            if isinstance(r, Value):
+                out += self.record.pack(3, r.target, r.number, r.value, r.time)
+            elif isinstance(r, Error):
+                out += self.record.pack(7, 0, 0, r.index, 0)
+            elif isinstance(r, History):
+                for t, value in r.samples:
+                    out += self.record.pack(3, r.target, r.number, value, t)
+        return bytes(out)
+
+
+class HistoryRing:
+    '''The most recent 'capacity' timestamped values of one param, in fixed memory'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.values = array.array('l', bytes(array.array('l').itemsize * capacity))
+        self.count = 0
+        self.head = 0
+
+    def add(self, timestamp, value):
+        # Samples stay in time order, a value older than the newest one is dropped
+        if self.count and timestamp < self.times[self.head - 1]:
+            return
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def since(self, start):
+        '''(times, values) lists for samples at or after 'start', oldest first'''
+        first = (self.head - self.count) % self.capacity
+        if first + self.count <= self.capacity:
+            times = self.times[first:first + self.count]
+            values = self.values[first:first + self.count]
+        else:
+            times = self.times[first:] + self.times[:self.head]
+            values = self.values[first:] + self.values[:self.head]
+        i = bisect.bisect_left(times, start)
+        return times[i:].tolist(), values[i:].tolist()
+
+
+def downsample(times, values, maxPoints):
+    '''At most 'maxPoints' (time, value) samples that keep the shape of the data.
+       Samples are split into maxPoints/2 buckets, and each bucket keeps its
+       minimum and maximum in time order, so spikes survive.
+       '''
+    if len(times) <= maxPoints:
+        return list(zip(times, values))
+    buckets = max(1, maxPoints // 2)
+    result = []
+    for b in range(buckets):
+        lo = len(times) * b // buckets
+        hi = len(times) * (b + 1) // buckets
+        chunk = range(lo, hi)
+        low = min(chunk, key=values.__getitem__)
+        high = max(chunk, key=values.__getitem__)
+        for i in sorted({low, high}):
+            result.append((times[i], values[i]))
+    return result
+
+
+class ParamHistory:
+    '''A HistoryRing for every param the server has read'''
+    capacity = 8192
+
+    def __init__(self):
+        self.rings = {}
+
+    def add(self, target, number, timestamp, value):
+        ring = self.rings.get((target, number))
+        if ring is None:
+            ring = self.rings[(target, number)] = HistoryRing(self.capacity)
+        ring.add(timestamp, value)
+
+    def fetch(self, target, number, since, maxPoints):
+        '''Downsampled (time, value) samples at or after 'since' seconds since the epoch.
+           A negative 'since' counts back from now.
+           '''
+        if since < 0:
+            since += time.time()
+        ring = self.rings.get((target, number))
+        if ring is None:
+            return []
+        times, values = ring.since(since)
+        return downsample(times, values, maxPoints)
+
+
+class ClientQueue:
+    '''Pushed samples waiting to go to one websocket client.
+
+       Bounded, and when a client falls behind the oldest samples are
+       dropped, so one slow client can't hold up the samplers, the serial
+       link or the other clients.
+       '''
+    maxsize = 256
+
+    def __init__(self, websocket, protocol):
+        self.websocket = websocket
+        self.protocol = protocol
+        self.messages = collections.deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.subscriptions = {}
+
+    def put(self, message):
+        if len(self.messages) >= self.maxsize:
+            self.messages.popleft()
+            self.dropped += 1
+        self.messages.append(message)
+        self.ready.set()
+
+    async def run(self):
+        # Everything queued while the last send was in progress goes out in one frame
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            messages = list(self.messages)
+            self.messages.clear()
+            await self.websocket.send(self.protocol.encode(messages))
+
+
+class ParamSampler:
+    '''One server-side sampling of a param, shared by every client subscribed to it.
+       Samples are fed in with publish(), on the event loop. Subclasses that
+       produce their own samples start and stop doing so in retune() and stop().
+       '''
+    def __init__(self, server, target, number):
+        self.server = server
+        self.target = target
+        self.number = number
+        self.subscribers = {}
+        self.latest = None
+
+    @property
+    def rate(self):
+        return max(rate for rate, due in self.subscribers.values())
+
+    def subscribe(self, client, rate):
+        oldRate = self.rate if self.subscribers else None
+        self.subscribers[client] = [rate, 0]
+        if self.latest:
+            self.publish(*self.latest, clients=[client])
+        if self.rate != oldRate:
+            self.retune()
+
+    def unsubscribe(self, client):
+        oldRate = self.rate
+        del self.subscribers[client]
+        if not self.subscribers:
+            self.stop()
+        elif self.rate != oldRate:
+            self.retune()
+
+    def publish(self, value, timestamp, clients=None):
+        if clients is None:
+            self.latest = (value, timestamp)
+            self.server.history.add(self.target, self.number, timestamp, value)
+        sample = Value(self.target, self.number, value, timestamp)
+        for client in (clients or list(self.subscribers)):
+            subscriber = self.subscribers[client]
+            rate, due = subscriber
+            # Half a period of slack, so jitter in the shared sampling doesn't skip samples
+            if timestamp + 0.5 / rate >= due:
+                subscriber[1] = max(due, timestamp - 0.5 / rate) + 1.0 / rate
+                client.put(sample)
+
+    def retune(self):
+        '''Start sampling, or change to the current rate. Nothing to do
+           when samples come from elsewhere, publish() applies each
+           subscriber's rate either way.
+           '''
+
+    def stop(self):
+        '''Stop sampling, the last subscriber is gone'''
+
+
+class TelemetrySampler(ParamSampler):
+    '''Samples through a threaded GimbalPort's TelemetryScheduler'''
+
+    def __init__(self, server, target, number):
+        ParamSampler.__init__(self, server, target, number)
+        self.loop = asyncio.get_event_loop()
+        self.subscription = None
+
+    def _sample(self, sample):
+        self.loop.call_soon_threadsafe(self._publishSample, sample)
+
+    def _publishSample(self, sample):
+        if self.subscribers:
+            self.publish(sample.value, sample.time)
+
+    def retune(self):
+        old = self.subscription
+        self.subscription = self.server.gimbal.telemetry.subscribe(
+            self.target, self.number, self.rate, self._sample)
+        if old:
+            self.server.gimbal.telemetry.unsubscribe(old)
+
+    def stop(self):
+        self.server.gimbal.telemetry.unsubscribe(self.subscription)
+        self.subscription = None
+
+
+class AsyncSampler(ParamSampler):
+    '''Samples an AsyncGimbalPort from a task on the event loop'''
+
+    def __init__(self, server, target, number):
+        ParamSampler.__init__(self, server, target, number)
+        self.task = None
+
+    async def _run(self):
+        deadline = time.time()
+        while True:
+            try:
+                value = await self.server.gimbal.get_param(self.target, self.number)
+                self.publish(value, time.time())
+            except Exception:
+                self.server.gimbal.metrics.count('telemetry.timeouts')
+            # Absolute deadlines, without bursting to catch up after a stall
+            period = 1.0 / self.rate
+            deadline = max(deadline + period, time.time() - period)
+            await asyncio.sleep(max(0, deadline - time.time()))
+
+    def retune(self):
+        # The task picks up the new rate after its current sample
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self.task.cancel()
+        self.task = None
+
+
 class SocketServer:
+    protocols = (TextProtocol, BinaryProtocol)
+    historyClass = ParamHistory
+
     def __init__(self, gimbal, host='', port=8893):
         self.gimbal = gimbal
         self.host = host
         self.port = port
+        self.native = isinstance(gimbal, AsyncGimbalPort)
+        self.samplerClass = AsyncSampler if self.native else TelemetrySampler
+        self.samplers = {}
+        self.history = self.historyClass()
 
     def uri(self):
         return "ws://%s:%d" % (self.host, self.port)
 
     def serve(self):
-        return websockets.serve(self.handle_client, self.host, self.port)
+        return websockets.serve(self.handle_client, self.host, self.port,
+            subprotocols=[p.name for p in self.protocols if p.name],
+            select_subprotocol=self.select_subprotocol)
+
+    def select_subprotocol(self, connection, offered):
+        '''Clients that don't ask for a known subprotocol get the text protocol'''
+        if isinstance(connection, (list, tuple)):
+            # Older websockets passes the client's list first
+            offered = connection
+        for p in self.protocols:
+            if p.name and p.name in offered:
+                return p.name
+
+    async def call(self, method, **kw):
+        '''Call a gimbal method by its AsyncGimbalPort name,
+           on either kind of gimbal object.
+           '''
+        if self.native:
+            return await getattr(self.gimbal, method)(**kw)
+        names = { 'get_param': 'getParam', 'get_params': 'getParams', 'set_param': 'setParam', 'set_motors': 'setMotors' }
+        fn = functools.partial(getattr(self.gimbal, names[method]), **kw)
+        return await asyncio.get_event_loop().run_in_executor(None, fn)
+
+    async def get_params(self, params):
+        '''Read (target, number) params all at once. Returns a list with
+           a value or an exception for each param.
+           '''
+        if self.native:
+            return await asyncio.gather(*(self.gimbal.get_param(target=t, number=n) for t, n in params),
+                return_exceptions=True)
+        try:
+            return await self.call('get_params', params=params)
+        except Exception as e:
+            if len(params) == 1:
+                return [e]
+        # One unanswered param fails a whole pipelined read, so find out which by reading each on its own
+        return await asyncio.gather(*(self.call('get_param', target=t, number=n) for t, n in params),
+            return_exceptions=True)
 
-    @asyncio.coroutine
-    def handle_client(self, websocket, path):
+    async def handle_client(self, websocket, path=None):
+        protocol = next(p for p in self.protocols if p.name == websocket.subprotocol)()
+        client = ClientQueue(websocket, protocol)
+        sender = asyncio.ensure_future(client.run())
         try:
             while True:
-                # Multiple commands can be batched into a websocket packet, one per line.
-                # Results are sent immediately, not batched.
-                results = []
-                for line in (yield from websocket.recv()).split('\n'):
-                    # Each line has space separated tokens
-                    yield from self.handle_command(websocket, line.split())
+                # Multiple commands can be batched into a websocket packet.
+                # Replies to a batch are sent back together, in one packet.
+                message = await websocket.recv()
+                try:
+                    commands = protocol.decode(message)
+                except Exception as e:
+                    # A frame that can't be decoded at all is answered as one failed command
+                    commands = [(0, e)]
+                replies = await self.handle_batch(commands, client)
+                if replies:
+                    await websocket.send(protocol.encode(replies))
         except websockets.exceptions.ConnectionClosed:
             return
+        finally:
+            sender.cancel()
+            for key in list(client.subscriptions):
+                self.unsubscribe(client, *key)
+
+    def subscribe(self, client, target, number, rate):
+        '''Push a param's value to a client 'rate' times a second'''
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        key = (target, number)
+        sampler = self.samplers.get(key)
+        if sampler is None:
+            sampler = self.samplers[key] = self.samplerClass(self, target, number)
+        client.subscriptions[key] = sampler
+        sampler.subscribe(client, rate)
+
+    def unsubscribe(self, client, target, number):
+        key = (target, number)
+        sampler = client.subscriptions.pop(key, None)
+        if sampler is None:
+            return
+        sampler.unsubscribe(client)
+        if not sampler.subscribers:
+            del self.samplers[key]
+
+    async def handle_batch(self, commands, client=None):
+        '''Run a batch of (index, Command) from a protocol's decode(),
+           returning a list of replies.
+
+           Consecutive gets are issued together and their replies keep the
+           batch's order. Any other command waits for everything before it,
+           so sets still happen in order and a get after a set sees the new
+           value. A failing command gets an Error reply, with its index in
+           the batch, instead of ending the connection.
+           '''
+        replies = []
+        gets = []
+        for index, command in commands:
+            if not isinstance(command, Exception) and command.op == 'get':
+                gets.append((index, command))
+                continue
+            replies += await self.handle_gets(gets)
+            gets = []
+            try:
+                if isinstance(command, Exception):
+                    raise command
+                reply = await self.handle_command(command, client)
+                if reply is not None:
+                    replies.append(reply)
+            except Exception as e:
+                replies.append(self.error(index, e))
+        replies += await self.handle_gets(gets)
+        return replies
 
-    @asyncio.coroutine
-    def handle_command(self, websocket, tokens):
-        loop = asyncio.get_event_loop()
+    async def handle_gets(self, gets):
+        if not gets:
+            return []
+        values = await self.get_params([(c.target, c.number) for index, c in gets])
+        now = time.time()
+        replies = []
+        for (index, c), value in zip(gets, values):
+            if isinstance(value, Exception):
+                replies.append(self.error(index, value, 'reading %d %d' % (c.target, c.number)))
+            else:
+                self.history.add(c.target, c.number, now, value)
+                replies.append(Value(c.target, c.number, value, now))
+        return replies
 
-        if tokens[0] == 'set':
-            fn = functools.partial(self.gimbal.setParam, target=int(tokens[1]), number=int(tokens[2]), value=int(tokens[3]))
-            yield from loop.run_in_executor(None, fn)
+    def error(self, index, e, context=None):
+        message = e.__class__.__name__
+        if context:
+            message += ' ' + context
+        if str(e):
+            message += ': ' + str(e)
+        return Error(index, message)
+
+    async def handle_command(self, command, client=None):
+        '''Run one command other than get, returning its reply or None'''
+        if command.op == 'set':
+            await self.call('set_param', target=command.target, number=command.number, value=command.value)
+            return
+
+        if command.op == 'motors':
+            await self.call('set_motors', enable=command.value)
             return
 
-        if tokens[0] == 'get':
-            fn = functools.partial(self.gimbal.getParam, target=int(tokens[1]), number=int(tokens[2]))
-            r = yield from loop.run_in_executor(None, fn)
-            yield from websocket.send('value %s %s %s' % (tokens[1], tokens[2], r))
+        if command.op == 'subscribe' and client:
+            # Values are pushed outside of any batch reply
+            self.subscribe(client, command.target, command.number, command.value)
             return
 
-        if tokens[0] == 'motors':
-            fn = functools.partial(self.gimbal.setMotors, int(tokens[1]))
-            yield from loop.run_in_executor(None, fn)
+        if command.op == 'unsubscribe' and client:
+            self.unsubscribe(client, command.target, command.number)
             return
 
-        raise ValueError("Unrecognized command %r" % tokens[0])
+        if command.op == 'stats':
+            return Stats(self.gimbal.stats())
+
+        if command.op == 'history':
+            since, maxPoints = command.value
+            return History(command.target, command.number,
+                self.history.fetch(command.target, command.number, since, maxPoints))
+
+        raise ValueError("Unrecognized command %r" % command.op)
 
 
 class ServerThread(threading.Thread):
@@ -67,22 +569,25 @@ class ServerThread(threading.Thread):
         self.setDaemon(True)
 
     def run(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())
         run_server(self.gimbal, **self.server_kwargs)
 
-def run_server(gimbal, **kw):
+async def serve_forever(gimbal, **kw):
     server = SocketServer(gimbal, **kw)
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(server.serve())
-    print("Server running at %s" % server.uri())
-    loop.run_forever()
+    async with server.serve():
+        print("Server running at %s" % server.uri())
+        await asyncio.Future()
+
+def run_server(gimbal, **kw):
+    asyncio.run(serve_forever(gimbal, **kw))
 
 def run_server_thread(gimbal, **kw):
     ServerThread(gimbal, **kw).start()
 
+async def open_and_serve():
+    await serve_forever(await AsyncGimbalPort.open())
+
 def main():
-    run_server(GimbalPort())
+    asyncio.run(open_and_serve())
 
 if __name__ == '__main__':
     main()
-
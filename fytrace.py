@@ -0,0 +1,64 @@
+'''
+Reading the text packet traces kept under traces/
+(No serial port dependency)
+
+Two line formats are understood:
+
+    RX <Pkt-AA55 t=00 cmd=00 [00047300]>
+    fygimbal-1: tx-data <Pkt-5AA5 t=00 cmd=08 [65002c01]>
+
+The first is printed by GimbalPort in verbose mode, where RX and TX are from
+the host's point of view. The second is sigrok output from the protocol
+decoder, where rx and tx are the two UART channels of that decoder instance.
+Other lines (comments, script output) are skipped.
+'''
+
+import re
+import glob
+import os
+import binascii
+import collections
+
+import fyproto
+
+LINE_PATTERN = re.compile(
+    r'^(?:(?P<host>RX|TX)|(?P<channel>[\w.-]+): (?P<sigrok>rx|tx)-data) '
+    r'<Pkt-(?P<framing>[0-9A-Fa-f]{4}) t=(?P<target>[0-9a-f]{2}) '
+    r'cmd=(?P<command>[0-9a-f]{2}) \[(?P<data>[0-9a-f]*)\]>')
+
+TraceRecord = collections.namedtuple('TraceRecord', 'lineno direction channel packet')
+
+
+def parse_line(line, lineno=None):
+    '''TraceRecord for one line of a trace, or None if it holds no packet.
+       Direction is 'rx' or 'tx'. Channel is the sigrok decoder name,
+       or an empty string for traces logged by GimbalPort.
+       '''
+    m = LINE_PATTERN.match(line)
+    if not m:
+        return None
+    if m.group('host'):
+        direction, channel = m.group('host').lower(), ''
+    else:
+        direction, channel = m.group('sigrok'), m.group('channel')
+    packet = fyproto.Packet(
+        command=int(m.group('command'), 16),
+        framing=int(m.group('framing'), 16),
+        target=int(m.group('target'), 16),
+        data=binascii.a2b_hex(m.group('data')))
+    return TraceRecord(lineno, direction, channel, packet)
+
+
+def read_trace(filename):
+    '''Iterate over the TraceRecords in a trace file'''
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            record = parse_line(line, lineno)
+            if record:
+                yield record
+
+
+def trace_files(directory=None):
+    '''Sorted list of text traces in the repository's traces/ directory'''
+    directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+    return sorted(glob.glob(os.path.join(directory, '*.txt')))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+'''
+Columnar store for the text traces under traces/, with vectorized queries.
+(No serial port dependency, requires NumPy)
+
+Importing streams each trace through fytrace into one row per packet,
+kept on disk as a NumPy array per column plus one file of concatenated
+payload bytes. Param conversations are rebuilt at the same time: each
+cmd06 request is paired with the next cmd06 value on the same channel,
+since responses come back in order of issue, and each cmd08 set is
+recorded with its value.
+
+    fytracedb.py import tracedb
+    fytracedb.py params tracedb --target 2 --number 0x09
+    fytracedb.py packets tracedb --command 0x0d --channel fygimbal-2
+    fytracedb.py compare tracedb --target 2
+
+Column files are memory-mapped on load, and TraceStore.packets is a
+fyproto.PacketBatch, so fyproto.decode_batch() works on it directly.
+'''
+
+import os
+import json
+import array
+import argparse
+import collections
+
+import numpy
+
+import fyproto
+import fytrace
+
+DIRECTIONS = ('rx', 'tx')
+KINDS = ('get', 'set')
+
+# (array typecode, NumPy dtype) for each stored packet column
+PACKET_COLUMNS = collections.OrderedDict([
+    ('file', ('h', '<i2')),
+    ('lineno', ('l', '<i4')),
+    ('direction', ('B', 'u1')),
+    ('channel', ('h', '<i2')),
+    ('framing', ('H', '<u2')),
+    ('target', ('B', 'u1')),
+    ('command', ('B', 'u1')),
+    ('length', ('H', '<u2')),
+    ('payload_offset', ('q', '<i8')),
+])
+
+# One row per param read (paired request and response) or param set.
+# 'row' is the packet row of the response or the set.
+PARAM_DTYPE = numpy.dtype([
+    ('row', '<i8'),
+    ('file', '<i2'),
+    ('lineno', '<i4'),
+    ('channel', '<i2'),
+    ('kind', 'u1'),
+    ('target', 'u1'),
+    ('number', 'u1'),
+    ('value', '<i2'),
+])
+
+
+class TraceBatch(fyproto.PacketBatch):
+    '''PacketBatch with the trace's own columns too: file, lineno, direction and channel.
+       'offset' is the packet's row number in the store.
+       '''
+    columns = fyproto.PacketBatch.columns + ('file', 'lineno', 'direction', 'channel')
+
+    def select(self, **fields):
+        '''Sub-batch of packets matching every given column.
+           Values can be single numbers or lists of acceptable numbers.
+           '''
+        mask = numpy.ones(len(self), dtype=bool)
+        for name, value in fields.items():
+            if value is None:
+                continue
+            column = getattr(self, name)
+            if isinstance(value, (list, tuple, set, range)):
+                mask &= numpy.isin(column, list(value))
+            else:
+                mask &= column == value
+        return self[mask]
+
+
+class ParamConversations:
+    '''Pairs cmd06 requests with their values, one FIFO per trace channel'''
+
+    def __init__(self):
+        self.pending = collections.defaultdict(collections.deque)
+        self.rows = []
+
+    def add(self, row, file, lineno, channel, packet):
+        message = fyproto.find_message(packet)
+        key = (file, channel)
+        if message is fyproto.PARAM_GET:
+            self.pending[key].append((packet.target, fyproto.PARAM_GET.decode(packet).number))
+        elif message is fyproto.PARAM_VALUE and packet.target == 3 and self.pending[key]:
+            target, number = self.pending[key].popleft()
+            self.rows.append((row, file, lineno, channel, 0, target, number,
+                fyproto.PARAM_VALUE.decode(packet).value))
+        elif message is fyproto.PARAM_SET:
+            m = fyproto.PARAM_SET.decode(packet)
+            self.rows.append((row, file, lineno, channel, 1, packet.target, m.number, m.value))
+
+    def array(self):
+        return numpy.array(self.rows, dtype=PARAM_DTYPE)
+
+
+def import_traces(directory, filenames):
+    '''Build a store in 'directory' from text traces'''
+    columns = { name: array.array(code) for name, (code, dtype) in PACKET_COLUMNS.items() }
+    payload = bytearray()
+    channels = {}
+    conversations = ParamConversations()
+    row = 0
+
+    for file, filename in enumerate(filenames):
+        for record in fytrace.read_trace(filename):
+            packet = record.packet
+            channel = channels.setdefault(record.channel, len(channels))
+            columns['file'].append(file)
+            columns['lineno'].append(record.lineno)
+            columns['direction'].append(DIRECTIONS.index(record.direction))
+            columns['channel'].append(channel)
+            columns['framing'].append(packet.framing)
+            columns['target'].append(packet.target)
+            columns['command'].append(packet.command)
+            columns['length'].append(len(packet.data))
+            columns['payload_offset'].append(len(payload))
+            payload += packet.data
+            conversations.add(row, file, record.lineno, channel, packet)
+            row += 1
+
+    os.makedirs(directory, exist_ok=True)
+    for name, (code, dtype) in PACKET_COLUMNS.items():
+        values = numpy.frombuffer(columns[name], dtype=code).astype(dtype)
+        numpy.save(os.path.join(directory, name + '.npy'), values)
+    with open(os.path.join(directory, 'payload.bin'), 'wb') as f:
+        f.write(payload)
+    numpy.save(os.path.join(directory, 'params.npy'), conversations.array())
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({
+            'files': [os.path.basename(name) for name in filenames],
+            'channels': sorted(channels, key=channels.get),
+        }, f, indent=2)
+    return row
+
+
+class TraceStore:
+    '''A store written by import_traces(), memory-mapped'''
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.files = meta['files']
+        self.channels = meta['channels']
+
+        columns = { name: numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                    for name in PACKET_COLUMNS }
+        columns['offset'] = numpy.arange(len(columns['file']))
+        payloadFile = os.path.join(directory, 'payload.bin')
+        if os.path.getsize(payloadFile):
+            payload = numpy.memmap(payloadFile, dtype=numpy.uint8, mode='r')
+        else:
+            payload = numpy.zeros(0, dtype=numpy.uint8)
+        self.packets = TraceBatch(payload, **columns)
+        self.params = numpy.load(os.path.join(directory, 'params.npy'), mmap_mode='r')
+
+    def fileNumber(self, name):
+        return None if name is None else self.files.index(os.path.basename(name))
+
+    def channelNumber(self, name):
+        return None if name is None else self.channels.index(name)
+
+    def paramValues(self, target=None, number=None, kind=None, file=None):
+        '''Rows of the params table matching every given field, as a structured array'''
+        mask = numpy.ones(len(self.params), dtype=bool)
+        for name, value in (('target', target), ('number', number), ('file', file),
+                            ('kind', None if kind is None else KINDS.index(kind))):
+            if value is not None:
+                mask &= self.params[name] == value
+        return self.params[mask]
+
+    def latestValues(self, file, kind='get'):
+        '''{(target, number): value} with the last value seen for each param in one trace file'''
+        rows = self.paramValues(file=file, kind=kind)
+        return { (int(r['target']), int(r['number'])): int(r['value']) for r in rows }
+
+
+def hexint(x):
+    return int(x, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import and query packet traces')
+    commands = parser.add_subparsers(dest='action', required=True)
+
+    p = commands.add_parser('import', help='Build a store from text traces')
+    p.add_argument('db')
+    p.add_argument('files', nargs='*', help='Trace files (default: traces/*.txt)')
+
+    p = commands.add_parser('packets', help='List packets')
+    p.add_argument('db')
+    p.add_argument('--file')
+    p.add_argument('--channel')
+    p.add_argument('--direction', choices=DIRECTIONS)
+    p.add_argument('--target', type=hexint)
+    p.add_argument('--command', type=hexint)
+    p.add_argument('--limit', type=int, default=None)
+
+    p = commands.add_parser('params', help='List param values read or written')
+    p.add_argument('db')
+    p.add_argument('--file')
+    p.add_argument('--target', type=hexint)
+    p.add_argument('--number', type=hexint)
+    p.add_argument('--kind', choices=KINDS)
+
+    p = commands.add_parser('compare', help='Last value read of every param, side by side per trace')
+    p.add_argument('db')
+    p.add_argument('--target', type=hexint, default=None, help='One target instead of all three')
+
+    args = parser.parse_args()
+
+    if args.action == 'import':
+        count = import_traces(args.db, args.files or fytrace.trace_files())
+        print("Imported %d packets into %s" % (count, args.db))
+        return
+
+    store = TraceStore(args.db)
+
+    if args.action == 'packets':
+        batch = store.packets.select(
+            file=store.fileNumber(args.file),
+            channel=store.channelNumber(args.channel),
+            direction=None if args.direction is None else DIRECTIONS.index(args.direction),
+            target=args.target, command=args.command)
+        for i in range(min(len(batch), args.limit or len(batch))):
+            print("%s:%d %s %s %s" % (store.files[batch.file[i]], batch.lineno[i],
+                store.channels[batch.channel[i]] or '-', DIRECTIONS[batch.direction[i]], batch[i]))
+
+    if args.action == 'params':
+        for r in store.paramValues(target=args.target, number=args.number, kind=args.kind,
+                                   file=store.fileNumber(args.file)):
+            print("%s:%d %s t=%d 0x%02x %d" % (store.files[r['file']], r['lineno'],
+                KINDS[r['kind']], r['target'], r['number'], r['value']))
+
+    if args.action == 'compare':
+        files = [i for i in range(len(store.files)) if len(store.paramValues(file=i, kind='get'))]
+        tables = [store.latestValues(i) for i in files]
+        targets = range(3) if args.target is None else [args.target]
+        print("--: " + ''.join("%-25s" % store.files[i] for i in files))
+        for n in range(128):
+            cells = [[table.get((t, n)) for t in targets] for table in tables]
+            print(("%02x: " % n) + ''.join("%-25s" % cell for cell in cells))
+
+
+if __name__ == '__main__':
+    main()
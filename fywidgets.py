@@ -4,9 +4,8 @@ Jupyter Notebook widgets for interacting with the Feiyu Tech gimbal protocol
 
 import ipywidgets
 import fyproto
-import struct
+import fyloop
 import threading
-import time
 from IPython.display import display
 
 
@@ -24,9 +23,10 @@ class LoopThread(threading.Thread):
 
 
 class ThreadToggle:
-    def __init__(self, loopFunc, **kw):
+    def __init__(self, loopFunc, stopFunc=None, **kw):
         self.thread = None
         self.loopFunc = loopFunc
+        self.stopFunc = stopFunc
         ipywidgets.interact(self.toggler, x=ipywidgets.ToggleButton(**kw))
 
     def toggler(self, x):
@@ -36,6 +36,8 @@ class ThreadToggle:
             self.thread.running = False
             self.thread.join()
             self.thread = None
+            if self.stopFunc:
+                self.stopFunc()
 
 
 class MotorControls:
@@ -48,13 +50,16 @@ class MotorControls:
 
 
 class ParamEditor:
+    refreshRate = 10.0
+
     def __init__(self, gimbal, number, axes=range(3), min=-0x8000, max=0x7fff, step=1):
         self.gimbal = gimbal
         self.number = number
         self.axes = axes
         self.widgets = [None] * 3
+        self.subscriptions = []
 
-        ThreadToggle(self._update, description='Refresh param %02x' % number)
+        ipywidgets.interact(self._refresh, x=ipywidgets.ToggleButton(description='Refresh param %02x' % number))
 
         for t in self.axes:
             v = self.gimbal.getParam(number=number, target=t)
@@ -62,9 +67,18 @@ class ParamEditor:
                 value=v, min=min, max=max, step=step,layout=dict(width='100%'))
             ipywidgets.interact(self._set, x=self.widgets[t], target=ipywidgets.fixed(t))
 
-    def _update(self):
-        for t in self.axes:
-            self.widgets[t].value = self.gimbal.getParam(number=self.number, target=t)
+    def _refresh(self, x):
+        # Polled by the gimbal's telemetry scheduler while the toggle is on
+        if x and not self.subscriptions:
+            self.subscriptions = [self.gimbal.telemetry.subscribe(target=t, number=self.number,
+                rate=self.refreshRate, callback=self._update) for t in self.axes]
+        if self.subscriptions and not x:
+            for s in self.subscriptions:
+                self.gimbal.telemetry.unsubscribe(s)
+            self.subscriptions = []
+
+    def _update(self, sample):
+        self.widgets[sample.target].value = sample.value
 
     def _set(self, x, target):
         self.gimbal.setParam(value=x, number=self.number, target=target)
@@ -81,17 +95,20 @@ class Controller:
         mw = ipywidgets.IntSlider(value=1, min=0, max=255, step=1, layout=dict(width='100%'))
         ipywidgets.interact(self.setFn, x=xw, y=yw, z=zw, m=mw)
 
-        ThreadToggle(self.loopFn, description='Controller thread')
-
         self.rate = ipywidgets.IntSlider(description='Update rate',
             value=25, min=1, max=400, step=1, layout=dict(width='100%'))
+        self.loop = fyloop.ControlLoop(hz=self.rate.value, metrics=gimbal.metrics, name='controller')
+
+        ThreadToggle(self.loopFn, stopFunc=self.loop.reset, description='Controller thread')
         display(self.rate)
 
     def setFn(self, x, y, z, m):
-        self.controlPacket = fyproto.Packet(target=0, command=0x01, data=struct.pack('<hhhB', x, y, z, m))
+        self.controlPacket = fyproto.CONTROL.encode(target=0, x=x, y=y, z=z, mode=m)
         print(self.controlPacket)
 
     def loopFn(self):
+        # One cycle per call, on the loop's deadlines at the slider's rate
+        self.loop.hz = self.rate.value
+        self.loop.tick()
         if self.controlPacket:
             self.gimbal.send(self.controlPacket)
-        time.sleep(1 / self.rate.value)
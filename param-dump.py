@@ -3,6 +3,6 @@ from fyserial import GimbalPort
 
 gimbal = GimbalPort()
 
-slots = [ gimbal.getVectorParam(n) for n in range(128) ]
+slots = gimbal.getVectorParams(range(128))
 
 print(repr(slots))
@@ -31,5 +31,5 @@ if args.command is not None:
 
 if args.read:
     while True:
-        for packet in rx.parse(port.read(1)):
+        for packet in rx.parse(port.read(max(1, port.in_waiting))):
             print(packet)